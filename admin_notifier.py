@@ -0,0 +1,137 @@
+import asyncio
+
+import discord
+
+# Discord embed limits
+MAX_FIELDS = 25
+MAX_FIELD_LENGTH = 1024
+MAX_EMBED_LENGTH = 6000
+
+TITLES = {
+    "info": "Info",
+    "error": "Errors",
+    "checker": "Subscription checker",
+    "expired": "Expired subscriptions",
+    "plex_failed": "Failed to remove from Plex",
+    "role_failed": "Failed to remove roles",
+    "dm_failed": "Failed to message users",
+    "roster": "Plex roster",
+    "subtitles": "Subtitles",
+    "stall": "Event loop stalls",
+}
+
+
+def field_values(messages):
+    """The messages packed into as few field values as they fit, one per line.
+
+    Only a message longer than a whole field is cut.
+    """
+    values = []
+    lines = []
+    length = 0
+    for message in messages:
+        if len(message) > MAX_FIELD_LENGTH:
+            message = message[: MAX_FIELD_LENGTH - 3] + "..."
+        if lines and length + len(message) + 1 > MAX_FIELD_LENGTH:
+            values.append("\n".join(lines))
+            lines = []
+            length = 0
+        lines.append(message)
+        length += len(message) + 1
+    if lines:
+        values.append("\n".join(lines))
+    return values
+
+
+class AdminNotifier:
+    """Queues admin notifications and sends them as a digest per flush.
+
+    Events are grouped by kind and flushed every `interval` seconds, or as soon as
+    `max_batch` are waiting. Urgent events skip the queue. notify() never blocks.
+    """
+
+    def __init__(self, bot, admin_id, interval=60, max_batch=50):
+        self.bot = bot
+        self.admin_id = admin_id
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._full = asyncio.Event()
+        self._admin = None
+        self._task = None
+        self._sending = set()
+
+    def notify(self, message, kind="info", urgent=False):
+        if urgent:
+            self._spawn(self._send(content=message))
+            return
+        self._pending.append((kind, message))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        for embed in self.digest(pending):
+            await self._send(embed=embed)
+
+    @staticmethod
+    def digest(pending):
+        """Fields grouped by kind, over as many embeds as Discord's size limits need."""
+        grouped = {}
+        for kind, message in pending:
+            grouped.setdefault(kind, []).append(message)
+        title = f"{len(pending)} notifications"
+        embeds = []
+        length = 0
+        fields = []
+        for kind, messages in grouped.items():
+            title_of_kind = TITLES.get(kind, kind)
+            for index, value in enumerate(field_values(messages)):
+                if index == 0:
+                    fields.append((f"{title_of_kind} ({len(messages)})", value))
+                else:
+                    fields.append((f"{title_of_kind} (continued)", value))
+        for name, value in fields:
+            size = len(name) + len(value)
+            if (
+                not embeds
+                or len(embeds[-1].fields) >= MAX_FIELDS
+                or length + size > MAX_EMBED_LENGTH
+            ):
+                embeds.append(discord.Embed(title=title, color=discord.Color.orange()))
+                length = len(title)
+            embeds[-1].add_field(name=name, value=value, inline=False)
+            length += size
+        return embeds
+
+    async def _send(self, **kwargs):
+        try:
+            if self._admin is None:
+                self._admin = self.bot.get_user(
+                    self.admin_id
+                ) or await self.bot.fetch_user(self.admin_id)
+            await self._admin.send(**kwargs)
+        except discord.Forbidden:
+            print("The bot does not have permission to send messages to the admin.")
+        except discord.HTTPException as e:
+            print(f"Failed to message the admin: {e}")
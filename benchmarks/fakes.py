@@ -0,0 +1,616 @@
+"""In-memory stand-ins for Mongo (motor), plex.tv, Stripe and Discord.
+
+Every call is counted in `calls`, keyed by upstream and method, and can be given a
+fixed latency to model round trips. Only the parts of each API the bot uses exist.
+"""
+
+import asyncio
+import collections
+import copy
+import itertools
+import time
+
+import pymongo
+from bson import ObjectId
+
+calls = collections.Counter()
+
+# Seconds added to every upstream call, set by the runner
+latency = 0.0
+
+
+async def round_trip(name):
+    calls[name] += 1
+    # Always yield, like real I/O does
+    await asyncio.sleep(latency)
+
+
+def blocking_round_trip(name):
+    # plexapi is synchronous and runs on the gateway's thread pool
+    calls[name] += 1
+    if latency:
+        time.sleep(latency)
+
+
+# Mongo
+
+
+def get_field(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else None
+        else:
+            return None
+    return value
+
+
+def has_field(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return False
+    return True
+
+
+def compare(value, op, operand):
+    if op == "$eq":
+        return value == operand or (isinstance(value, list) and operand in value)
+    if op == "$ne":
+        return not compare(value, "$eq", operand)
+    if op == "$in":
+        return any(compare(value, "$eq", item) for item in operand)
+    if op == "$nin":
+        return not compare(value, "$in", operand)
+    if value is None or operand is None:
+        return False
+    if op == "$lt":
+        return value < operand
+    if op == "$lte":
+        return value <= operand
+    if op == "$gt":
+        return value > operand
+    if op == "$gte":
+        return value >= operand
+    raise NotImplementedError(f"fake Mongo does not support {op}")
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"fake Mongo does not support {key}")
+        elif isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            value = get_field(doc, key)
+            for op, operand in condition.items():
+                if op == "$exists":
+                    if has_field(doc, key) != bool(operand):
+                        return False
+                elif not compare(value, op, operand):
+                    return False
+        elif not compare(get_field(doc, key), "$eq", condition):
+            return False
+    return True
+
+
+def apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                doc[key] = copy.deepcopy(value)
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                doc[key] = doc.get(key, 0) + value
+            elif op == "$push":
+                doc.setdefault(key, []).append(copy.deepcopy(value))
+            elif op != "$setOnInsert":
+                raise NotImplementedError(f"fake Mongo does not support {op}")
+
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    included = {key for key, on in projection.items() if on}
+    included.add("_id")
+    return {key: copy.deepcopy(value) for key, value in doc.items() if key in included}
+
+
+def sort_docs(docs, sort):
+    for key, direction in reversed(sort or []):
+        docs.sort(
+            key=lambda doc: (get_field(doc, key) is not None, get_field(doc, key)),
+            reverse=direction == pymongo.DESCENDING,
+        )
+    return docs
+
+
+Result = collections.namedtuple(
+    "Result",
+    ["matched_count", "modified_count", "deleted_count", "upserted_id", "inserted_id"],
+    defaults=[0, 0, 0, None, None],
+)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+    async def to_list(self, length):
+        return self._docs if length is None else self._docs[:length]
+
+
+class FakeCollection:
+    """A dict of documents by _id, with hash indexes built lazily for equality lookups."""
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self._indexes = {}
+        self._index_info = {"_id_": {"key": [("_id", 1)]}}
+
+    def load(self, docs):
+        """Insert seed data without counting calls."""
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+            self.docs[doc["_id"]] = doc
+            self._index(doc)
+
+    def clear(self):
+        self.docs.clear()
+        self._indexes.clear()
+
+    def _index(self, doc, remove=False):
+        for field, index in self._indexes.items():
+            value = get_field(doc, field)
+            if isinstance(value, (dict, list)):
+                continue
+            if remove:
+                index.get(value, set()).discard(doc["_id"])
+            else:
+                index.setdefault(value, set()).add(doc["_id"])
+
+    def _candidates(self, query):
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self.docs.get(query["_id"])
+            return [doc] if doc is not None else []
+        for field, condition in query.items():
+            if field.startswith("$") or isinstance(condition, (dict, list)):
+                continue
+            if field not in self._indexes:
+                self._indexes[field] = {}
+                for doc in self.docs.values():
+                    value = get_field(doc, field)
+                    if not isinstance(value, (dict, list)):
+                        self._indexes[field].setdefault(value, set()).add(doc["_id"])
+            return [self.docs[i] for i in self._indexes[field].get(condition, ())]
+        return list(self.docs.values())
+
+    def _find(self, query, sort=None):
+        found = [
+            doc for doc in self._candidates(query or {}) if matches(doc, query or {})
+        ]
+        return sort_docs(found, sort)
+
+    def _write(self, doc, update, inserting=False):
+        self._index(doc, remove=True)
+        apply_update(doc, update, inserting)
+        self._index(doc)
+
+    def _upsert(self, query, update):
+        doc = {
+            key: value
+            for key, value in query.items()
+            if not key.startswith("$") and not isinstance(value, dict)
+        }
+        doc.setdefault("_id", ObjectId())
+        apply_update(doc, update, inserting=True)
+        self.docs[doc["_id"]] = doc
+        self._index(doc)
+        return doc
+
+    def find(self, query=None, projection=None, sort=None, **kwargs):
+        calls["mongo.find"] += 1
+        return FakeCursor([project(doc, projection) for doc in self._find(query, sort)])
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        await round_trip("mongo.find_one")
+        found = self._find(query, sort)
+        return project(found[0], projection) if found else None
+
+    async def count_documents(self, query):
+        await round_trip("mongo.count_documents")
+        return len(self._find(query))
+
+    async def insert_one(self, doc):
+        await round_trip("mongo.insert_one")
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.docs:
+            raise pymongo.errors.DuplicateKeyError(f"duplicate _id {doc['_id']}")
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+        self._index(self.docs[doc["_id"]])
+        return Result(inserted_id=doc["_id"])
+
+    async def update_one(self, query, update, upsert=False):
+        await round_trip("mongo.update_one")
+        found = self._find(query)
+        if found:
+            self._write(found[0], update)
+            return Result(matched_count=1, modified_count=1)
+        if upsert:
+            return Result(upserted_id=self._upsert(query, update)["_id"])
+        return Result()
+
+    async def update_many(self, query, update):
+        await round_trip("mongo.update_many")
+        found = self._find(query)
+        for doc in found:
+            self._write(doc, update)
+        return Result(matched_count=len(found), modified_count=len(found))
+
+    async def find_one_and_update(
+        self, query, update, sort=None, return_document=False, upsert=False, **kwargs
+    ):
+        await round_trip("mongo.find_one_and_update")
+        found = self._find(query, sort)
+        if not found:
+            if upsert:
+                doc = self._upsert(query, update)
+                return copy.deepcopy(doc) if return_document else None
+            return None
+        before = copy.deepcopy(found[0])
+        self._write(found[0], update)
+        return copy.deepcopy(found[0]) if return_document else before
+
+    async def find_one_and_delete(self, query, sort=None):
+        await round_trip("mongo.find_one_and_delete")
+        found = self._find(query, sort)
+        if not found:
+            return None
+        self._index(found[0], remove=True)
+        return self.docs.pop(found[0]["_id"])
+
+    async def delete_one(self, query):
+        await round_trip("mongo.delete_one")
+        found = self._find(query)
+        if not found:
+            return Result()
+        self._index(found[0], remove=True)
+        del self.docs[found[0]["_id"]]
+        return Result(deleted_count=1)
+
+    async def delete_many(self, query):
+        await round_trip("mongo.delete_many")
+        found = self._find(query)
+        for doc in found:
+            self._index(doc, remove=True)
+            del self.docs[doc["_id"]]
+        return Result(deleted_count=len(found))
+
+    async def create_index(self, keys, **options):
+        await round_trip("mongo.create_index")
+        self._index_info[options.get("name", str(keys))] = {"key": keys}
+
+    async def index_information(self):
+        await round_trip("mongo.index_information")
+        return dict(self._index_info)
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection(name)
+        return self[name]
+
+
+class FakeMongoClient:
+    """Drop-in for motor's AsyncIOMotorClient. Every client sees the same data, like
+    clients of one server.
+    """
+
+    databases = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, FakeDatabase())
+
+    def clear(self):
+        for database in self.databases.values():
+            for collection in database.values():
+                collection.clear()
+
+
+# plex.tv
+
+
+class FakeResource:
+    def __init__(self, machine_identifier):
+        self.machineIdentifier = machine_identifier
+
+
+class FakePlexUser:
+    def __init__(self, email, machine_identifier):
+        self.email = email
+        self.username = email.split("@")[0]
+        self.servers = [FakeResource(machine_identifier)]
+
+
+class FakePlexAccount:
+    """The MyPlexAccount sharing methods the gateway calls."""
+
+    def __init__(self, server):
+        self.server = server
+        self.friends = {}
+        self.invites = {}
+
+    def users(self):
+        blocking_round_trip("plex.users")
+        return list(self.friends.values())
+
+    def pendingInvites(self, includeSent=True, includeReceived=True):
+        blocking_round_trip("plex.pendingInvites")
+        return list(self.invites.values())
+
+    def inviteFriend(self, user, server, sections=None, allowSync=False, **kwargs):
+        blocking_round_trip("plex.inviteFriend")
+        if user.lower() in self.friends:
+            raise Exception(f"{user} is already sharing this server")
+        self.invites[user.lower()] = FakePlexUser(user, server.machineIdentifier)
+
+    def removeFriend(self, user):
+        blocking_round_trip("plex.removeFriend")
+        email = user if isinstance(user, str) else user.email
+        if self.friends.pop(email.lower(), None) is None:
+            raise Exception(f"{email} is not a friend")
+
+    def cancelInvite(self, user):
+        blocking_round_trip("plex.cancelInvite")
+        email = user if isinstance(user, str) else user.email
+        if self.invites.pop(email.lower(), None) is None:
+            raise Exception(f"{email} has no pending invite")
+
+    def share(self, emails):
+        """Seed existing shares without counting calls."""
+        for email in emails:
+            self.friends[email.lower()] = FakePlexUser(
+                email, self.server.machineIdentifier
+            )
+
+
+class FakeSection:
+    def __init__(self, key, title, type):
+        self.key = key
+        self.title = title
+        self.type = type
+
+
+class FakeLibrary:
+    def __init__(self, sections):
+        self._sections = sections
+
+    def sections(self):
+        blocking_round_trip("plex.sections")
+        return list(self._sections)
+
+
+class FakePlexServer:
+    def __init__(self):
+        self.machineIdentifier = "fake-machine"
+        self.library = FakeLibrary(
+            [
+                FakeSection(1, "Movies", "movie"),
+                FakeSection(2, "TV Shows", "show"),
+                FakeSection(3, "Movies 4K", "movie"),
+            ]
+        )
+        self.account = FakePlexAccount(self)
+
+    def myPlexAccount(self):
+        blocking_round_trip("plex.myPlexAccount")
+        return self.account
+
+
+# Stripe
+
+
+class StripeObject(dict):
+    """Attribute access like stripe's objects."""
+
+    __getattr__ = dict.get
+
+
+_ids = itertools.count(1)
+
+
+def new_id(prefix):
+    return f"{prefix}_{next(_ids):08d}"
+
+
+class FakeListObject:
+    def __init__(self, items, name, page_size):
+        self._items = items
+        self._name = name
+        self._page_size = page_size
+
+    async def auto_paging_iter(self):
+        for first in range(0, len(self._items), self._page_size):
+            if first:
+                await round_trip(self._name)  # fetching the next page
+            for item in self._items[first : first + self._page_size]:
+                yield item
+
+
+class FakeStripeResource:
+    prefix = "obj"
+    name = "Object"
+    objects = None
+
+    @classmethod
+    def reset(cls):
+        cls.objects = {}
+
+    @classmethod
+    def add(cls, **fields):
+        """Seed an object without counting calls."""
+        fields.setdefault("created", int(time.time()))
+        obj = StripeObject(id=new_id(cls.prefix), **fields)
+        cls.objects[obj.id] = obj
+        return obj
+
+    @classmethod
+    async def create(cls, **params):
+        await round_trip(f"stripe.{cls.name}.create")
+        return cls.add(**params)
+
+    @classmethod
+    async def retrieve(cls, id):
+        await round_trip(f"stripe.{cls.name}.retrieve")
+        return cls.objects[id]
+
+    @classmethod
+    async def list(cls, limit=10, status=None, created=None, **params):
+        await round_trip(f"stripe.{cls.name}.list")
+        items = [
+            obj
+            for obj in cls.objects.values()
+            if (status is None or obj.status == status)
+            and (created is None or obj.created >= created.get("gte", 0))
+        ]
+        return FakeListObject(items, f"stripe.{cls.name}.list", limit)
+
+
+class FakeCustomer(FakeStripeResource):
+    prefix = "cus"
+    name = "Customer"
+
+
+class FakeInvoiceItem(FakeStripeResource):
+    prefix = "ii"
+    name = "InvoiceItem"
+
+
+class FakeInvoice(FakeStripeResource):
+    prefix = "in"
+    name = "Invoice"
+
+    @classmethod
+    async def create(cls, **params):
+        await round_trip("stripe.Invoice.create")
+        return cls.add(status="draft", **params)
+
+    @classmethod
+    async def finalize_invoice(cls, id):
+        await round_trip("stripe.Invoice.finalize_invoice")
+        invoice = cls.objects[id]
+        invoice["status"] = "open"
+        invoice["hosted_invoice_url"] = f"https://invoice.stripe.test/{id}"
+        return invoice
+
+    @classmethod
+    async def void_invoice(cls, id):
+        await round_trip("stripe.Invoice.void_invoice")
+        cls.objects[id]["status"] = "void"
+        return cls.objects[id]
+
+
+class FakeCheckoutSession(FakeStripeResource):
+    prefix = "cs"
+    name = "checkout.Session"
+
+    @classmethod
+    async def create(cls, **params):
+        await round_trip("stripe.checkout.Session.create")
+        session = cls.add(status="open", payment_status="unpaid", **params)
+        session["url"] = f"https://checkout.stripe.test/{session.id}"
+        return session
+
+    @classmethod
+    async def expire(cls, id):
+        await round_trip("stripe.checkout.Session.expire")
+        cls.objects[id]["status"] = "expired"
+        return cls.objects[id]
+
+
+def install_stripe(stripe):
+    """Point the stripe module's resources at the fakes."""
+    for resource in (FakeCustomer, FakeInvoiceItem, FakeInvoice, FakeCheckoutSession):
+        resource.reset()
+    stripe.Customer = FakeCustomer
+    stripe.InvoiceItem = FakeInvoiceItem
+    stripe.Invoice = FakeInvoice
+    stripe.checkout.Session = FakeCheckoutSession
+
+
+# Discord
+
+
+class FakeRole:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeUser:
+    def __init__(self, id):
+        self.id = id
+        self.mention = f"<@{id}>"
+
+    async def send(self, content=None, **kwargs):
+        await round_trip("discord.send")
+
+
+class FakeMember(FakeUser):
+    async def add_roles(self, *roles):
+        await round_trip("discord.add_roles")
+
+    async def remove_roles(self, *roles):
+        await round_trip("discord.remove_roles")
+
+
+class FakeGuild:
+    def __init__(self, id, role_ids):
+        self.id = id
+        self.roles = [FakeRole(role_id) for role_id in role_ids]
+
+    def get_member(self, id):
+        return FakeMember(id)
+
+
+class FakeDiscord:
+    """The lookups bot.py makes on the Bot object, all members are in the guild."""
+
+    def __init__(self, guild):
+        self.guild = guild
+
+    def get_guild(self, id):
+        return self.guild
+
+    def get_user(self, id):
+        return FakeUser(id)
+
+    async def fetch_user(self, id):
+        await round_trip("discord.fetch_user")
+        return FakeUser(id)
+
+    def install(self, bot):
+        bot.get_guild = self.get_guild
+        bot.get_user = self.get_user
+        bot.fetch_user = self.fetch_user
@@ -0,0 +1,437 @@
+"""Benchmark the bot's background jobs offline against simulated upstreams.
+
+Mongo, plex.tv, Stripe and Discord are replaced by the in-memory stand-ins in
+benchmarks/fakes.py, and a synthetic subscriber set is generated for each run. Every
+job reports wall time, calls per upstream and peak traced memory, and the results are
+appended to benchmarks/results.jsonl and compared with the previous matching run.
+
+Usage: python -m benchmarks.run --subscribers 10000 [--jobs checker,reinvite] [--latency-ms 5]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import motor.motor_asyncio
+import yaml
+from async_stripe import stripe
+from bson import ObjectId
+
+from benchmarks import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT, "benchmarks", "results.jsonl")
+GUILD_ID = 1000
+PLANS = [
+    {
+        "name": "Basic",
+        "stripe_price_id": "price_basic",
+        "price": 3,
+        "concurrent_streams": 2,
+        "downloads_enabled": False,
+        "4k_enabled": False,
+        "role_id": 2001,
+    },
+    {
+        "name": "Standard",
+        "stripe_price_id": "price_standard",
+        "price": 5,
+        "concurrent_streams": 3,
+        "downloads_enabled": True,
+        "4k_enabled": True,
+        "role_id": 2002,
+    },
+    {
+        "name": "Extra",
+        "stripe_price_id": "price_extra",
+        "price": 10,
+        "concurrent_streams": 5,
+        "downloads_enabled": True,
+        "4k_enabled": True,
+        "role_id": 2003,
+    },
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument(
+        "--jobs", default=",".join(JOBS), help=f"comma separated, from {list(JOBS)}"
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="simulated round trip added to every upstream call",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip the second, traced run that measures peak memory",
+    )
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument(
+        "--no-record", action="store_true", help="don't append to the results file"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with an error if a job got slower or bigger than --tolerance",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    return parser.parse_args()
+
+
+def load_bot(workdir):
+    """Import bot.py wired to the fakes, without connecting to anything."""
+    plans_file = os.path.join(workdir, "plans.yml")
+    with open(plans_file, "w") as file:
+        yaml.safe_dump({"plans": PLANS}, file)
+    os.environ.update(
+        {
+            "GUILD_ID": str(GUILD_ID),
+            "DISCORD_ADMIN_ID": "1",
+            "DISCORD_ADMIN_ROLE_ID": "1",
+            "PLANS_FILE": plans_file,
+            "PLEX_CACHE_FILE": os.path.join(workdir, "plex_cache.json"),
+            # A single server, whatever servers.yml the checkout has
+            "SERVERS_FILE": os.path.join(workdir, "servers.yml"),
+            "PLEX_SERVER_CAPACITY": "1000000000",
+            # Empty so complete_payment asks Stripe instead of waiting for a webhook
+            "STRIPE_WEBHOOK_SECRET": "",
+        }
+    )
+    motor.motor_asyncio.AsyncIOMotorClient = fakes.FakeMongoClient
+    fakes.install_stripe(stripe)
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import bot
+    return bot
+
+
+def synthetic_subscribers(count, rng, now):
+    """Mostly healthy subscribers, with some expired and some in each warning window."""
+    subscribers = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.05:
+            expiration_date = now - datetime.timedelta(hours=rng.uniform(1, 48))
+        elif roll < 0.14:
+            days = rng.choice([5, 3, 1])
+            expiration_date = now + datetime.timedelta(
+                days=days - 1, hours=rng.uniform(1, 23)
+            )
+        else:
+            expiration_date = now + datetime.timedelta(days=rng.uniform(6, 60))
+        plan = rng.choice(PLANS)
+        subscribers.append(
+            {
+                "email": f"subscriber{i}@example.com",
+                "discord_id": 10**17 + i,
+                "expiration_date": expiration_date,
+                "plan_id": plan["stripe_price_id"],
+                "plan_name": plan["name"],
+                "expired": False,
+            }
+        )
+    return subscribers
+
+
+class Harness:
+    def __init__(self, bot, subscribers, seed):
+        self.bot = bot
+        self.subscribers = subscribers
+        self.seed = seed
+        self.server = fakes.FakePlexServer()
+        self.client = fakes.FakeMongoClient()
+        self.plex = self.client["pycord"]["plex"]
+        self.payments = self.client["pycord"]["payments"]
+        fakes.FakeDiscord(
+            fakes.FakeGuild(GUILD_ID, [plan["role_id"] for plan in PLANS])
+        ).install(bot.bot)
+        bot.plex_gateway.set_server(self.server)
+        bot.server_pool.primary.set_sections(self.server.library._sections)
+
+    def reset(self):
+        self.client.clear()
+        fakes.install_stripe(stripe)
+        self.server.account.friends.clear()
+        self.server.account.invites.clear()
+        roster = self.bot.server_pool.primary.roster
+        roster.friends, roster.invites, roster.refreshed_at = {}, {}, None
+        self.bot.admin_notifier._pending.clear()
+        self.rng = random.Random(self.seed)
+        self.now = datetime.datetime.utcnow()
+
+    def seed_subscribers(self, shared_fraction=1.0):
+        subscribers = synthetic_subscribers(self.subscribers, self.rng, self.now)
+        self.plex.load(subscribers)
+        self.server.account.share(
+            user["email"] for user in subscribers if self.rng.random() < shared_fraction
+        )
+        return subscribers
+
+    def seed_payment(self, discord_id, status, created):
+        plan = self.rng.choice(PLANS)
+        invoice = fakes.FakeInvoice.add(
+            customer=fakes.new_id("cus"),
+            status=status,
+            created=int(created.replace(tzinfo=datetime.timezone.utc).timestamp()),
+        )
+        self.payments.load(
+            [
+                {
+                    # Payment records are dated by their ObjectId
+                    "_id": ObjectId(
+                        ObjectId.from_datetime(created).binary[:4]
+                        + ObjectId().binary[4:]
+                    ),
+                    "discord_id": discord_id,
+                    "email": f"buyer{discord_id}@example.com",
+                    "invoice_id": invoice.id,
+                    "paid": False,
+                    "invoice_url": f"https://invoice.stripe.test/{invoice.id}",
+                    "active": True,
+                    "plan_name": plan["name"],
+                    "plan_id": plan["stripe_price_id"],
+                    "checkout": "invoice",
+                    "stripe_customer_id": invoice.customer,
+                }
+            ]
+        )
+
+
+# Each job is (setup, run): setup seeds the fakes for a harness and returns the
+# argument for run, run is the coroutine being measured and returns a summary
+
+
+def setup_checker(harness):
+    harness.seed_subscribers()
+
+
+async def run_checker(harness, _):
+    await harness.bot.subscriptionCheckerLoop.coro()
+    return {
+        "removed": harness.subscribers - len(harness.plex.docs),
+        "outbox": len(harness.client["pycord"]["outbox"].docs),
+    }
+
+
+def setup_complete_payment(harness):
+    # A launch-day burst: a tenth of the subscriber count buying at once
+    buyers = [2 * 10**17 + i for i in range(max(1, harness.subscribers // 10))]
+    for discord_id in buyers:
+        harness.seed_payment(discord_id, "paid", harness.now)
+    return buyers
+
+
+async def run_complete_payment(harness, buyers):
+    semaphore = asyncio.Semaphore(50)
+
+    async def click(discord_id):
+        async with semaphore:
+            return await harness.bot.complete_payment(discord_id)
+
+    results = await asyncio.gather(*map(click, buyers))
+    return {"added": sum(result.startswith("Payment verified") for result in results)}
+
+
+def setup_payment_sweep(harness):
+    # A third paid, a third abandoned days ago, a third recently opened
+    stale = harness.now - datetime.timedelta(days=2)
+    count = max(3, harness.subscribers // 10)
+    for i in range(count):
+        status, created = [
+            ("paid", harness.now),
+            ("open", stale),
+            ("open", harness.now),
+        ][i % 3]
+        harness.seed_payment(3 * 10**17 + i, status, created)
+
+
+async def run_payment_sweep(harness, _):
+    await harness.bot.paymentReconcileLoop.coro()
+    active = harness.payments._find({"active": True})
+    return {"still_pending": len(active)}
+
+
+def setup_reinvite(harness):
+    harness.seed_subscribers(shared_fraction=0.5)
+
+
+async def run_reinvite(harness, _):
+    import reinvite
+    from plex_gateway import PlexGateway, RateLimiter
+
+    def connect_plex(config, rate):
+        sections = harness.server.library._sections
+        standard = [section for section in sections if "4K" not in section.title]
+        gateway = PlexGateway(harness.server, rate_limiter=RateLimiter(rate))
+        return gateway, standard, sections
+
+    reinvite.connect_plex = connect_plex
+    # The real default is 30 calls a minute, lift it to measure the script itself
+    argv = sys.argv
+    sys.argv = ["reinvite.py", "--rate", "1000000000", "--run-id", "benchmark"]
+    try:
+        await reinvite.main()
+    finally:
+        sys.argv = argv
+    return {"invites": len(harness.server.account.invites)}
+
+
+JOBS = {
+    "checker": (setup_checker, run_checker),
+    "complete_payment": (setup_complete_payment, run_complete_payment),
+    "payment_sweep": (setup_payment_sweep, run_payment_sweep),
+    "reinvite": (setup_reinvite, run_reinvite),
+}
+
+
+async def measure(harness, name, memory):
+    setup, run = JOBS[name]
+    harness.reset()
+    argument = setup(harness)
+    fakes.calls.clear()
+    started = time.perf_counter()
+    summary = await run(harness, argument)
+    wall = time.perf_counter() - started
+    calls = dict(sorted(fakes.calls.items()))
+
+    peak = None
+    if memory:
+        # tracemalloc slows everything down, so memory gets its own run
+        harness.reset()
+        argument = setup(harness)
+        tracemalloc.start()
+        await run(harness, argument)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return wall, calls, peak, summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(path):
+    previous = {}
+    try:
+        with open(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    key = (
+                        record["job"],
+                        record["subscribers"],
+                        record["latency_ms"],
+                    )
+                    previous[key] = record
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def change(new, old):
+    if new is None or not old:
+        return ""
+    return f" ({(new - old) / old:+.0%})"
+
+
+async def main():
+    args = parse_args()
+    names = [name.strip() for name in args.jobs.split(",") if name.strip()]
+    unknown = [name for name in names if name not in JOBS]
+    if unknown:
+        sys.exit(f"Unknown jobs: {', '.join(unknown)}")
+    fakes.latency = args.latency_ms / 1000
+    previous = previous_results(args.results)
+    revision = git_revision()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = load_bot(workdir)
+        harness = Harness(bot, args.subscribers, args.seed)
+        # reinvite.py reads plans.yml from the working directory
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        records = []
+        try:
+            for name in names:
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    wall, calls, peak, summary = await measure(
+                        harness, name, not args.no_memory
+                    )
+                records.append(
+                    {
+                        "job": name,
+                        "subscribers": args.subscribers,
+                        "latency_ms": args.latency_ms,
+                        "wall_s": round(wall, 3),
+                        "peak_mb": round(peak / 2**20, 2) if peak else None,
+                        "calls": calls,
+                        "summary": summary,
+                        "revision": revision,
+                        "recorded_at": datetime.datetime.utcnow().isoformat(
+                            timespec="seconds"
+                        ),
+                    }
+                )
+        finally:
+            os.chdir(cwd)
+            bot.plex_gateway.shutdown()
+
+    regressions = []
+    for record in records:
+        old = previous.get(
+            (record["job"], record["subscribers"], record["latency_ms"]), {}
+        )
+        memory = "not measured"
+        if record["peak_mb"] is not None:
+            memory = (
+                f"{record['peak_mb']} MB{change(record['peak_mb'], old.get('peak_mb'))}"
+            )
+        print(
+            f"{record['job']}: {record['wall_s']}s{change(record['wall_s'], old.get('wall_s'))}, "
+            f"peak {memory}, {sum(record['calls'].values())} upstream calls, {record['summary']}"
+        )
+        for upstream, count in record["calls"].items():
+            print(
+                f"    {upstream}: {count}{change(count, old.get('calls', {}).get(upstream))}"
+            )
+        for metric in ("wall_s", "peak_mb"):
+            if record[metric] and old.get(metric):
+                if record[metric] > old[metric] * (1 + args.tolerance):
+                    regressions.append(f"{record['job']} {metric}")
+
+    if not args.no_record:
+        with open(args.results, "a") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+    if regressions:
+        print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,57 @@
+import asyncio
 import datetime
 import math
 import os
-import re
-import sys
+import traceback
 
 import discord
 import dotenv
 import motor.motor_asyncio
-import yaml
 from async_stripe import stripe
 from discord.ext import tasks
-from plexapi.myplex import MyPlexAccount
+
+from admin_notifier import AdminNotifier
+from capacity import Capacity
+from diagnostics import JobProfiler, LoopMonitor
+from expiry_scheduler import ExpiryScheduler
+from interactions import InteractionRunner
+from library_index import LibraryIndex
+from library_stats import LibraryStats
+from media_resolver import MediaNotFound, MediaResolver, parse_media_url
+from metrics import (
+    MongoCommandMetrics,
+    collector,
+    count_error,
+    gauge,
+    metrics_handler,
+    timed,
+    track,
+)
+from migrations import ensure_indexes, run_migrations
+from outbox import Outbox, cancelled_key, expired_key, warning_key
+from plan_registry import load_plan_registry
+from plex_connection import connect_server, load_cache, save_cache
+from plex_gateway import PlexGateway
+from server_pool import PoolServer, ServerPool, load_server_configs
+from stats_channels import StatsChannels
+from stripe_checkout import (
+    CHECKOUT_SESSION,
+    INVOICE,
+    create_checkout_session,
+    create_customer,
+    create_invoice,
+    retrieve_payment,
+    sweep_payments,
+    void_payment,
+)
+from subtitles import VALID_SUBTITLE_EXTENSIONS, SubtitleError, SubtitlePipeline
+from webhooks import start_web_server, stripe_webhook_handler
 
 # Load Environment Variables
 dotenv.load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 PLEX_SERVER_URL = os.getenv("PLEX_SERVER_URL")
-PLEX_TOKEN = os.getenv("PLEX_SERVER_TOKEN")
+PLEX_TOKEN = os.getenv("PLEX_TOKEN") or os.getenv("PLEX_SERVER_TOKEN")
 GUILD_ID = os.getenv("GUILD_ID")
 MONGODB_URL = os.getenv("MONGODB_URL")
 PLEX_USERNAME = os.getenv("PLEX_USERNAME")
@@ -27,113 +62,412 @@ STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
 DISCORD_ADMIN_ID = os.getenv("DISCORD_ADMIN_ID")
 STATS = os.getenv("STATS")
 STATS_CHANNEL_ID = os.getenv("STATS_CHANNEL_ID")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Where Checkout Sessions send the user after paying
+STRIPE_SUCCESS_URL = (
+    os.getenv("STRIPE_SUCCESS_URL") or f"https://discord.com/channels/{GUILD_ID}"
+)
+WEB_HOST = os.getenv("WEB_HOST") or "0.0.0.0"
+WEB_PORT = int(os.getenv("WEB_PORT") or 8080)
+PLEX_WORKERS = int(os.getenv("PLEX_WORKERS") or 8)
+PLEX_CACHE_FILE = os.getenv("PLEX_CACHE_FILE") or ".plex_cache.json"
+PLANS_FILE = os.getenv("PLANS_FILE") or "plans.yml"
+PLEX_SERVER_CAPACITY = int(os.getenv("PLEX_SERVER_CAPACITY") or 100)
+# Pool of Plex servers, without it the single server configured above is used
+SERVERS_FILE = os.getenv("SERVERS_FILE") or "servers.yml"
+# How long a slot is held for an unpaid invoice
+CAPACITY_RESERVATION_MINUTES = int(os.getenv("CAPACITY_RESERVATION_MINUTES") or 60)
+# Shares on the server that are not subscribers but must never be removed (e.g. family)
+PLEX_ROSTER_IGNORE = {
+    email.strip().lower()
+    for email in (os.getenv("PLEX_ROSTER_IGNORE") or "").split(",")
+    if email.strip()
+}
+ROSTER_REMOVE_UNKNOWN = os.getenv("ROSTER_REMOVE_UNKNOWN") == "true"
+# Unpaid invoices and checkout sessions older than this are cancelled
+PAYMENT_EXPIRY_HOURS = int(os.getenv("PAYMENT_EXPIRY_HOURS") or 24)
+# Workers delivering subscriber DMs from the outbox
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS") or 3)
+# How often queued admin notifications are sent as one digest
+ADMIN_DIGEST_SECONDS = int(os.getenv("ADMIN_DIGEST_SECONDS") or 60)
+# Serve Prometheus metrics on WEB_HOST:WEB_PORT/metrics
+METRICS = os.getenv("METRICS") == "true"
+# Report event loop stalls longer than LOOP_STALL_MS with the stack that caused them
+DIAGNOSTICS = os.getenv("DIAGNOSTICS") == "true"
+LOOP_STALL_MS = int(os.getenv("LOOP_STALL_MS") or 250)
+# Save sampled profiles of the subscription checker and stats runs to PROFILE_DIR
+PROFILE_JOBS = os.getenv("PROFILE_JOBS") == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR") or "profiles"
+# Subtitle uploads (a zip counts as one) each user may make per hour
+SUBTITLE_UPLOADS_PER_HOUR = int(os.getenv("SUBTITLE_UPLOADS_PER_HOUR") or 10)
+# Resolved Plex media kept for media commands, dropped early when the item changes
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE") or 512)
+MEDIA_CACHE_MINUTES = int(os.getenv("MEDIA_CACHE_MINUTES") or 10)
+# SQLite full-text index of the library behind /search
+LIBRARY_INDEX_FILE = os.getenv("LIBRARY_INDEX_FILE") or "library.db"
+
+# Days before expiry at which a subscriber is warned
+NOTIFICATION_DAYS = [5, 3, 1]
+CHECKER_BATCH_SIZE = 100
+CHECKER_CONCURRENCY = 10
+ROSTER_BATCH_SIZE = 20
+# Discord allows 25 options per select menu and 5 rows, one of them used by the payment buttons
+PLANS_PER_SELECT = 25
 
-VALID_SUBTITLE_EXTENSIONS = [".srt", ".smi", ".ssa", ".ass", ".vtt"]
 
+# Setup Stripe
+stripe.api_key = STRIPE_API_KEY
 
-def load_plans():
-    with open("plans.yml", "r") as file:
-        plans_data = yaml.safe_load(file)
-    return plans_data["plans"]
 
+# Setup MongoDB with motor
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    MONGODB_URL, event_listeners=[MongoCommandMetrics()]
+)
+db_plex = client["pycord"]
+db_payments = client["pycord"]
+db_subscriptions = client["pycord"]
 
-plans = load_plans()
 
-role_ids = []
+# Setup Plex Servers
+# Connections are made in the background after Discord logs in (see connectPlex),
+# each server's gateway holds its Plex calls until it is ready.
+server_pool = ServerPool(
+    [
+        PoolServer(
+            config,
+            PlexGateway(None, max_workers=PLEX_WORKERS),
+            Capacity(
+                db_plex["capacity"],
+                db_plex["capacity_reservations"],
+                server=config["name"],
+                limit=config["capacity"],
+                reservation_ttl=datetime.timedelta(
+                    minutes=CAPACITY_RESERVATION_MINUTES
+                ),
+            ),
+        )
+        for config in load_server_configs(
+            SERVERS_FILE,
+            {
+                "name": PLEX_SERVER_NAME or "default",
+                "url": PLEX_SERVER_URL,
+                "token": PLEX_TOKEN,
+                "capacity": PLEX_SERVER_CAPACITY,
+                "cache_file": PLEX_CACHE_FILE,
+            },
+        )
+    ],
+    db_plex["capacity_reservations"],
+)
 
-for plan in plans:
-    role_ids.append(plan["role_id"])
+# Library counts, media lookups, /search and subtitles use the primary server
+plex_gateway = server_pool.primary.gateway
+sections_movies = server_pool.primary.sections_movies
+sections_tv = server_pool.primary.sections_tv
 
-# Setup Stripe
-stripe.api_key = STRIPE_API_KEY
 
+library_stats = LibraryStats(plex_gateway, sections_movies, sections_tv)
+# Shared by every command that takes a Plex media URL
+media_resolver = MediaResolver(
+    plex_gateway, max_size=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_MINUTES * 60
+)
+library_stats.on_change(media_resolver.invalidate_change)
+library_index = LibraryIndex(
+    LIBRARY_INDEX_FILE, plex_gateway, sections_movies, sections_tv
+)
+library_stats.on_change(library_index.on_change)
 
-# Setup Plex Server
-try:
-    print("Connecting to Plex... This may take a few seconds.")
-    account = MyPlexAccount(PLEX_USERNAME, PLEX_PASSWORD)
-    plex = account.resource(PLEX_SERVER_NAME).connect()  # returns a PlexServer instance
-    print("Connected to Plex Server")
 
-except Exception as e:
-    print(e)
-    sys.exit()
+# Plans, swapped for a new registry when plans.yml changes (see plansReloadLoop)
+plan_registry = load_plan_registry(PLANS_FILE)
+plans_checked_mtime = plan_registry.mtime
 
 
-# setup sections
+# Background tasks started from here, the loop only keeps weak references to tasks
+background_tasks = set()
 
-sections_standard = []
-sections_4k = []
-sections_all = []
 
-sections_movies = []
-sections_tv = []
+def startTask(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
-for section in plex.library.sections():
-    if "4K" not in section.title:
-        sections_standard.append(section)
-    sections_all.append(section)
 
-    if section.type == "movie":
-        sections_movies.append(section)
-    elif section.type == "show":
-        sections_tv.append(section)
+async def indexLibrary():
+    try:
+        count = await library_index.build()
+        print(f"Indexed {count} library items for /search")
+    except Exception as e:
+        contactAdmin(f"Error indexing the Plex library: {e}", kind="error")
 
 
-# Setup MongoDB with motor
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
-db_plex = client["pycord"]
-db_payments = client["pycord"]
-db_subscriptions = client["pycord"]
+async def connectPlex(pool_server):
+    gateway = pool_server.gateway
+    print(
+        f"Connecting to Plex server {pool_server.name}... This may take a few seconds."
+    )
+    cache = load_cache(pool_server.cache_file)
+    while True:
+        try:
+            server = await gateway.run(
+                "connect",
+                connect_server,
+                cache,
+                url=pool_server.url,
+                token=pool_server.token,
+                username=PLEX_USERNAME,
+                password=PLEX_PASSWORD,
+                server_name=pool_server.name,
+            )
+            break
+        except Exception as e:
+            print(
+                f"Failed to connect to Plex server {pool_server.name}, retrying in 60 seconds: {e}"
+            )
+            contactAdmin(
+                f"Failed to connect to Plex server {pool_server.name}: {e}", urgent=True
+            )
+            await asyncio.sleep(60)
+
+    if cache.get("machine_identifier") == server.machineIdentifier:
+        # Invites can go out with the cached sections while the list is refetched
+        pool_server.set_sections(cache["sections"])
+        gateway.set_server(server)
+    print(f"Connected to Plex server {pool_server.name}")
+    # server.library is fetched on first use, so it has to be read on the worker too
+    sections = await gateway.run("connect", lambda: server.library.sections())
+    pool_server.set_sections(sections)
+    if not gateway.ready.is_set():
+        gateway.set_server(server)
+    try:
+        save_cache(pool_server.cache_file, server, sections)
+    except OSError as e:
+        print(f"Could not write the Plex cache for {pool_server.name}: {e}")
+
+
+async def connectPool():
+    # The other servers connect alongside, the library features follow the primary
+    for pool_server in server_pool:
+        if pool_server is not server_pool.primary:
+            startTask(connectPlex(pool_server))
+    await connectPlex(server_pool.primary)
+
+    library_stats.start()
+    if await library_index.built_at() is None:
+        startTask(indexLibrary())
+    libraryRecountLoop.start()
+    rosterRefreshLoop.start()
+    rosterReconcileLoop.start()
+    if STATS == "true":
+        stats_update.start()
+
+
+subtitle_pipeline = SubtitlePipeline(
+    db_plex["subtitles"],
+    plex_gateway,
+    workers=plex_gateway.limits["upload"],
+    rate_limit=SUBTITLE_UPLOADS_PER_HOUR,
+)
+
+stats_channels = StatsChannels(
+    db_plex["settings"], {"movies": "Movies", "shows": "Shows", "episodes": "Episodes"}
+)
 
 # Setup Discord Bot
 print("Connecting to Discord... This may take a few seconds.")
 intents = discord.Intents.all()
 bot = discord.Bot(intents=intents)
+interactions = InteractionRunner()
+admin_notifier = AdminNotifier(
+    bot, int(DISCORD_ADMIN_ID), interval=ADMIN_DIGEST_SECONDS
+)
+job_profiler = JobProfiler(PROFILE_DIR, enabled=PROFILE_JOBS)
+
+
+startup_complete = False
+
+# Timers of running slash commands, keyed by interaction id
+command_timers = {}
+
+subscriber_count = gauge("plexbot_subscribers", "Subscribers with a Plex share.")
+capacity_slots = gauge(
+    "plexbot_capacity_slots", "Slots used, reserved and available per Plex server."
+)
+pending_invoices = gauge(
+    "plexbot_pending_invoices", "Invoices and checkout sessions waiting for payment."
+)
+
+
+@collector
+async def collectGauges():
+    subscriber_count.set(await db_plex["plex"].count_documents({}))
+    for pool_server in server_pool:
+        status = await pool_server.capacity.status()
+        for state in ("used", "reserved", "limit"):
+            capacity_slots.set(status[state], server=pool_server.name, state=state)
+    pending_invoices.set(
+        await db_payments["payments"].count_documents({"paid": False, "active": True})
+    )
+
+
+@bot.before_invoke
+async def startCommandTimer(ctx):
+    # Entered here and left in after_invoke, both run in the command's task
+    timer = track("command", ctx.command.qualified_name)
+    command_timers[ctx.interaction.id] = timer.__enter__()
+
+
+@bot.after_invoke
+async def stopCommandTimer(ctx):
+    timer = command_timers.pop(ctx.interaction.id, None)
+    if timer is not None:
+        timer.__exit__(None, None, None)
+
+
+@bot.listen()
+async def on_application_command_error(ctx, error):
+    # after_invoke already timed it, this only counts the failure
+    count_error("command", ctx.command.qualified_name)
+    # Listening here replaces the default handler, so keep its traceback
+    traceback.print_exception(type(error), error, error.__traceback__)
+
+
+# Built once per plan registry by installPlanViews and reused for every click
+plan_view = None
+payment_views = {}
+
+
+def installPlanViews(registry):
+    global plan_view, payment_views
+    views = {
+        registry.key(plan): PaymentOptionsView(plan, registry.key(plan))
+        for plan in registry.plans
+    }
+    menu = PlanView(registry)
+    # Registering replaces any view already listening on the same custom IDs
+    for view in views.values():
+        bot.add_view(view)
+    bot.add_view(menu)
+    plan_view, payment_views = menu, views
+
+
+async def syncCapacity():
+    # Reset every server's counter from the subscribers placed on it
+    for pool_server in server_pool:
+        await pool_server.capacity.sync(
+            await db_plex["plex"].count_documents(
+                server_pool.record_filter(pool_server)
+            )
+        )
+
+
+async def setupDatabase():
+    collections = {
+        "plex": db_plex["plex"],
+        "payments": db_payments["payments"],
+        "capacity_reservations": db_plex["capacity_reservations"],
+        "outbox": db_plex["outbox"],
+    }
+    version = await run_migrations(collections, db_plex["migrations"])
+    print(f"Database schema at version {version}")
+    await syncCapacity()
+    for problem in await ensure_indexes(collections):
+        print(f"Index problem: {problem}")
+        contactAdmin(f"Index problem: {problem}", urgent=True)
+
+
+async def prepareDatabase():
+    # Retried until Mongo answers, the bot keeps serving in the meantime
+    while True:
+        try:
+            await setupDatabase()
+            await outbox.start()
+            return
+        except Exception as e:
+            print(f"Database setup failed, retrying in 60 seconds: {e}")
+            contactAdmin(f"Database setup failed: {e}", urgent=True)
+            await asyncio.sleep(60)
 
 
 @bot.event
 async def on_ready():
-    bot.add_view(PlanView())
+    global startup_complete
+    # on_ready fires again after every reconnect, only run the setup once
+    if startup_complete:
+        return
+    startup_complete = True
+    admin_notifier.start()
+    if DIAGNOSTICS:
+        loop_monitor.start()
+    # Views and loops first, a failure further down must not leave the bot without them
+    installPlanViews(plan_registry)
     bot.add_view(
         ManageSubscriptionButton()
     )  # Registers a View for persistent listening
+    expiry_scheduler.start()
     subscriptionCheckerLoop.start()
-    if STATS == "true":
-        stats_update.start()
+    plansReloadLoop.start()
+    capacityLoop.start()
+    paymentReconcileLoop.start()
+    startTask(connectPool())
+    startTask(prepareDatabase())
+    await subtitle_pipeline.start()
+    routes = []
+    if STRIPE_WEBHOOK_SECRET:
+        routes.append(
+            (
+                "POST",
+                "/stripe/webhook",
+                stripe_webhook_handler(
+                    STRIPE_WEBHOOK_SECRET,
+                    {
+                        "invoice.paid": onPaymentPaid,
+                        "invoice.voided": onPaymentVoided,
+                        "checkout.session.completed": onPaymentPaid,
+                        "checkout.session.async_payment_succeeded": onPaymentPaid,
+                        "checkout.session.expired": onPaymentVoided,
+                    },
+                ),
+            )
+        )
+    if METRICS:
+        routes.append(("GET", "/metrics", metrics_handler))
+    if routes:
+        try:
+            await start_web_server(routes, WEB_HOST, WEB_PORT)
+        except OSError as e:
+            contactAdmin(f"Failed to start the web server: {e}", urgent=True)
     print(f"We have logged in as {bot.user}")
 
 
-async def add_to_plex(email, discord_id, plan_name):
+async def sharePlex(email, plan_name, pool_server):
+    selected_plan = plan_registry.get(plan_name)
+    if selected_plan is None:
+        raise ValueError(f"plan {plan_name} is not in {PLANS_FILE}")
+    downloads_enabled = selected_plan["downloads_enabled"]
+    add_sections = pool_server.sections_for(selected_plan)
+    await pool_server.gateway.invite_friend(
+        email, add_sections, allow_sync=downloads_enabled
+    )
+    pool_server.roster.mark_invited(email)
+
+
+async def add_to_plex(email, discord_id, plan_name, pool_server):
     test = await db_plex["plex"].find_one({"email": email})
     if test is not None:
         return "Your Plex account is already in the database."
     try:
-        # find "downloads_enabled" and "4k_enabled" in the plans value and set them to the vars here
-        selected_plan = next(
-            (plan for plan in plans if plan["name"] == plan_name), None
-        )
-        downloads_enabled = selected_plan["downloads_enabled"]
-        enabled_4k = selected_plan["4k_enabled"]
-        if enabled_4k:
-            add_sections = sections_all
-        else:
-            add_sections = sections_standard
-        plex.myPlexAccount().inviteFriend(
-            email,
-            plex,
-            allowSync=downloads_enabled,
-            sections=add_sections,
-        )
+        await sharePlex(email, plan_name, pool_server)
         # If successful, add the email, discord id and share status to the database
         await db_plex["plex"].insert_one(
             {
                 "email": email,
                 "discord_id": discord_id,
+                "server": pool_server.name,
                 "expiration_date": None,
                 "plan_id": None,
                 "plan_name": None,
-                "sent_notifications": [],
                 "expired": False,
             }
         )
@@ -151,7 +485,14 @@ async def add_to_plex(email, discord_id, plan_name):
 #     await ctx.respond(f"Pong! {int(bot.latency * 1000)}ms", ephemeral=True)
 
 
-async def donate(email: str, stripe_price_id: str, discord_author_id: str, plan_name):
+async def donate(
+    email: str,
+    stripe_price_id: str,
+    discord_author_id: str,
+    plan_name,
+    reserve_slot=False,
+):
+    pool_server = None
     try:
         # Check if the user already has a pending invoice
         existing_payment = await db_payments["payments"].find_one(
@@ -162,44 +503,77 @@ async def donate(email: str, stripe_price_id: str, discord_author_id: str, plan_
                 f"You already have a pending invoice for the plan **{existing_payment['plan_name']}**. Please pay it at {existing_payment['invoice_url']} or use the cancel button to cancel the existing invoice before creating a new one.  **Click the green Complete Payment button after paying**",
             )
 
-        # Create Stripe customer
-        customer = await stripe.Customer.create(email=email)
-        # Create Stripe invoice
-        invoice_item = await stripe.InvoiceItem.create(
-            customer=customer.id,
-            price=stripe_price_id,  # Replace with your Stripe price ID
-        )
-
-        invoice = await stripe.Invoice.create(
-            customer=customer.id,
-            auto_advance=True,
-            pending_invoice_items_behavior="include",
-        )
+        plan = plan_registry.get(plan_name)
+        # New subscribers hold a slot on the least loaded server while their invoice is open
+        if reserve_slot:
+            pool_server = await server_pool.place(discord_author_id, plan)
+            if pool_server is None:
+                return (
+                    "You cannot subscribe right now, the server is currently full. Please try again later.",
+                )
 
-        # Finalize the invoice
-        finalised_invoice = await stripe.Invoice.finalize_invoice(invoice.id)
+        checkout = plan.get("checkout", INVOICE) if plan else INVOICE
+        customer_id = await stripeCustomerId(discord_author_id, email)
+        if checkout == CHECKOUT_SESSION:
+            # One call, the invoice_id field holds the session ID
+            invoice_id, invoice_url = await create_checkout_session(
+                stripe_price_id,
+                email,
+                customer_id,
+                discord_author_id,
+                plan_name,
+                STRIPE_SUCCESS_URL,
+            )
+        else:
+            if customer_id is None:
+                customer_id = await create_customer(email, discord_author_id)
+            invoice_id, invoice_url = await create_invoice(customer_id, stripe_price_id)
 
         # Log unpaid invoice to the "payments" MongoDB collection
         await db_payments["payments"].insert_one(
             {
                 "discord_id": discord_author_id,
                 "email": email,
-                "invoice_id": finalised_invoice.id,
+                "invoice_id": invoice_id,
                 "paid": False,
-                "invoice_url": finalised_invoice.hosted_invoice_url,
+                "invoice_url": invoice_url,
                 "active": True,
                 "plan_name": plan_name,
                 "plan_id": stripe_price_id,
+                "checkout": checkout,
+                "stripe_customer_id": customer_id,
+                "server": pool_server.name if pool_server else None,
             }
         )
 
         # Send the invoice URL to the user
         # Direct message the user the link as well
-        return finalised_invoice.hosted_invoice_url
+        return invoice_url
     except Exception as e:
+        if pool_server is not None:
+            await server_pool.release(discord_author_id)
         return f"Error creating your subscription, {e}"
 
 
+async def stripeCustomerId(discord_id, email):
+    # Reuse the Stripe customer from the subscription or an earlier payment with the same email
+    subscriber = await db_plex["plex"].find_one(
+        {"discord_id": discord_id, "email": email}, {"stripe_customer_id": 1}
+    )
+    if subscriber and subscriber.get("stripe_customer_id"):
+        return subscriber["stripe_customer_id"]
+    payment = await db_payments["payments"].find_one(
+        {
+            "discord_id": discord_id,
+            "email": email,
+            "stripe_customer_id": {"$ne": None},
+        },
+        {"stripe_customer_id": 1},
+        sort=[("_id", -1)],
+    )
+    return payment["stripe_customer_id"] if payment else None
+
+
 async def add_time(discord_id):
     plex_data = await db_plex["plex"].find_one({"discord_id": discord_id})
     email, stripe_price_id, plan_name = (
@@ -211,6 +585,21 @@ async def add_time(discord_id):
     return await donate(email, stripe_price_id, discord_id, plan_name)
 
 
+async def paymentReply(user, donate_return):
+    # donate returns the payable URL, or an error message
+    if isinstance(donate_return, tuple):
+        return donate_return[0]
+    if donate_return.startswith("Error"):
+        return donate_return
+    try:
+        await user.send(
+            f"Please pay the invoice at the following URL: {donate_return}.  **Click the green Complete Payment button after paying**"
+        )
+    except discord.HTTPException:
+        pass  # DMs closed, the link is in the reply
+    return f"Please pay the invoice at the following URL: {donate_return}, the link has also been messaged to you. **Click the green Complete Payment button after paying**"
+
+
 class EmailModal(discord.ui.Modal):
     def __init__(self, plan, plan_name, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
@@ -218,27 +607,21 @@ class EmailModal(discord.ui.Modal):
         self.plan = plan
         self.plan_name = plan_name
 
+    @timed("modal", "email")
     async def callback(self, interaction: discord.Interaction):
         email = self.children[0].value
-        donate_return = await donate(
-            email,
-            self.plan,
-            interaction.user.id,
-            plan_name=self.plan_name,
-        )
-        if donate_return[0].startswith("You"):
-            await interaction.response.send_message(
-                donate_return[0],
-                ephemeral=True,
+
+        async def work():
+            donate_return = await donate(
+                email,
+                self.plan,
+                interaction.user.id,
+                plan_name=self.plan_name,
+                reserve_slot=True,
             )
-            return
-        await interaction.response.send_message(
-            f"Please pay the invoice at the following URL: {donate_return}, the link has also been messaged to you. **Click the green Complete Payment button after paying**",
-            ephemeral=True,
-        )
-        await interaction.user.send(
-            f"Please pay the invoice at the following URL: {donate_return}.  **Click the green Complete Payment button after paying**"
-        )
+            return await paymentReply(interaction.user, donate_return)
+
+        await interactions.run(interaction, work, group="payment")
 
 
 @bot.slash_command(guild_ids=[GUILD_ID])
@@ -274,6 +657,7 @@ class ManageSubscriptionButton(
         style=discord.ButtonStyle.primary,
         custom_id="manage_subscription",
     )
+    @timed("button", "manage_subscription")
     async def first_button_callback(self, button, interaction):
         subscription_info = await checkSubscriptionInfo(interaction.user.id)
         expiration_date = subscription_info[0]
@@ -310,21 +694,13 @@ class ManageSubscriptionMenu(discord.ui.View):
         style=discord.ButtonStyle.primary,
         custom_id="add_time",
     )
+    @timed("button", "add_time")
     async def first_button_callback(self, button, interaction):
-        donate_return = await add_time(self.discord_id)
-        if donate_return[0].startswith("You"):
-            await interaction.response.send_message(
-                donate_return[0],
-                ephemeral=True,
-            )
-            return
-        await interaction.response.send_message(
-            f"Please pay the invoice at the following URL: {donate_return}, the link has also been messaged to you.  **Click the green Complete Payment button after paying**",
-            ephemeral=True,
-        )
-        await interaction.user.send(
-            f"Please pay the invoice at the following URL: {donate_return}.  **Click the green Complete Payment button after paying**"
-        )
+        async def work():
+            donate_return = await add_time(self.discord_id)
+            return await paymentReply(interaction.user, donate_return)
+
+        await interactions.run(interaction, work, group="payment")
 
     @discord.ui.button(
         label="Complete Payment",
@@ -332,9 +708,10 @@ class ManageSubscriptionMenu(discord.ui.View):
         style=discord.ButtonStyle.green,
         custom_id="complete_payment",
     )
+    @timed("button", "complete_payment")
     async def second_button_callback(self, button, interaction):
-        await interaction.response.send_message(
-            await complete_payment(interaction.user.id), ephemeral=True
+        await interactions.run(
+            interaction, lambda: complete_payment(interaction.user.id), group="payment"
         )
 
     @discord.ui.button(
@@ -343,15 +720,13 @@ class ManageSubscriptionMenu(discord.ui.View):
         style=discord.ButtonStyle.red,
         custom_id="cancel_payment",
     )
+    @timed("button", "cancel_payment")
     async def third_button_callback(self, button, interaction):
-        await interaction.response.send_message(
-            await cancel_payment(interaction.user.id), ephemeral=True
+        await interactions.run(
+            interaction, lambda: cancel_payment(interaction.user.id), group="payment"
         )
 
 
-# make a list of role ids from plans yml
-
-
 @bot.slash_command(description="Upload a subtitle to Plex", guild_ids=[GUILD_ID])
 async def upload_subtitles(
     ctx,
@@ -360,41 +735,34 @@ async def upload_subtitles(
     ),
     subtitle_file: discord.Option(
         discord.SlashCommandOptionType.attachment,
-        description=f"Upload a subtitle file with one of the following extensions: {', '.join(VALID_SUBTITLE_EXTENSIONS)}",
+        description=f"A subtitle ({', '.join(VALID_SUBTITLE_EXTENSIONS)}), or a zip of SxxEyy-named subtitles for a show or season",
     ),
 ):
-    if not any(
-        subtitle_file.filename.lower().endswith(ext)
-        for ext in VALID_SUBTITLE_EXTENSIONS
-    ):
-        await ctx.respond(
-            f"Invalid subtitle file type. The file must be one of the following types: {', '.join(VALID_SUBTITLE_EXTENSIONS)}.",
-            ephemeral=True,
-        )
-        await contactAdmin(
-            f"{ctx.author.mention} tried to upload a subtitle file with an invalid extension: {subtitle_file.filename}."
-        )
-        return
-    pattern = r"metadata%2F(\d+)&context"
-    match = re.search(pattern, media_url)
-    if not match:
+    media_id = parse_media_url(media_url)
+    if media_id is None:
         await ctx.respond(
             "Invalid media URL, please copy the url on the media page.",
             ephemeral=True,
         )
         return
-    media_id = match.group(1)
-    media = plex.fetchItem(int(media_id))
 
-    # Check if the directory exists, and if not, create it.
-    directory = "./subtitles/"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    async def work():
+        try:
+            media = await media_resolver.get(media_id)
+        except MediaNotFound as e:
+            return str(e)
+        try:
+            return await subtitle_pipeline.submit(ctx.author.id, media, subtitle_file)
+        except SubtitleError as e:
+            contactAdmin(
+                f"{ctx.author.mention} could not upload {subtitle_file.filename}: {e}",
+                kind="subtitles",
+            )
+            return str(e)
+        except Exception as e:
+            return f"Could not upload {subtitle_file.filename}. Error: {e}"
 
-    await subtitle_file.save(f"{directory}{subtitle_file.filename}")
-    subtitle_path = f"{directory}{subtitle_file.filename}"
-    media.uploadSubtitles(subtitle_path)
-    return await ctx.respond(f"Uploaded subtitle {subtitle_file.filename}.")
+    await interactions.run(ctx.interaction, work, group="subtitles")
 
 
 @bot.slash_command(guild_ids=[GUILD_ID])
@@ -405,23 +773,7 @@ async def send_plans_embed(ctx):
         )
         return
 
-    embed = discord.Embed()
-    for plan in plans:
-        embed.add_field(
-            name=plan["name"],
-            value=(
-                f"Price: ${plan['price']}\n"
-                f"Concurrent Streams: {plan['concurrent_streams']}\n"
-                f"Downloads Enabled: {'Yes*' if plan['downloads_enabled'] else 'No'}\n"
-                f"4K Enabled: {'Yes' if plan['4k_enabled'] else 'No'}\n"
-            ),
-            inline=True,
-        )
-    embed.add_field(
-        name="",
-        value="*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/.",
-        inline=False,
-    )
+    embed = plan_registry.summary_embed
     await ctx.send(embed=embed)
 
 
@@ -434,130 +786,123 @@ async def lookup_subscription(discord_id):
     user_data = await db_payments["plex"].find_one({"discord_id": discord_id})
 
 
-class PlanView(
-    discord.ui.View
-):  # Create a class called MyView that subclasses discord.ui.View
-    def __init__(self):
-        super().__init__(timeout=None)  # timeout of the view must be set to None
+class PersistentView(discord.ui.View):
+    """A view whose one instance is sent with many messages.
 
-    @discord.ui.button(
-        label="Basic", row=0, style=discord.ButtonStyle.primary, custom_id="basic"
-    )
-    async def first_button_callback(self, button, interaction):
-        embed = discord.Embed(
-            title="Chosen Plan",
-            color=discord.Color.blue(),
-        )
-        embed.add_field(
-            name=plans[0]["name"],
-            value=(
-                f"Price: ${plans[0]['price']}\n"
-                f"Concurrent Streams: {plans[0]['concurrent_streams']}\n"
-                f"Downloads Enabled: {'Yes*' if plans[0]['downloads_enabled'] else 'No'}\n"
-                f"4K Enabled: {'Yes' if plans[0]['4k_enabled'] else 'No'}\n"
-            ),
-            inline=False,
-        )
-        if plans[0]["downloads_enabled"]:
-            embed.add_field(
-                name="",
-                value="*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/.",
-                inline=False,
-            )
-        await interaction.response.send_message(
-            view=PaymentOptionsView(plan=plans[0]), ephemeral=True, embed=embed
-        )
+    py-cord gives views sent in ephemeral messages a 15 minute timeout, which would stop
+    the shared instance for everyone, so the timeout is pinned to None.
+    """
 
-    @discord.ui.button(
-        label="Standard", row=0, style=discord.ButtonStyle.primary, custom_id="standard"
-    )
-    async def second_button_callback(self, button, interaction):
-        embed = discord.Embed(
-            title="Chosen Plan",
-            color=discord.Color.blue(),
-        )
-        embed.add_field(
-            name=plans[1]["name"],
-            value=(
-                f"Price: ${plans[1]['price']}\n"
-                f"Concurrent Streams: {plans[1]['concurrent_streams']}\n"
-                f"Downloads Enabled: {'Yes*' if plans[1]['downloads_enabled'] else 'No'}\n"
-                f"4K Enabled: {'Yes' if plans[1]['4k_enabled'] else 'No'}\n"
-            ),
-            inline=False,
-        )
-        if plans[1]["downloads_enabled"]:
-            embed.add_field(
-                name="",
-                value="*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/.",
-                inline=False,
-            )
-        await interaction.response.send_message(
-            embed=embed, view=PaymentOptionsView(plan=plans[1]), ephemeral=True
-        )
+    def __init__(self):
+        super().__init__(timeout=None)
 
-    @discord.ui.button(
-        label="Extra", row=0, style=discord.ButtonStyle.primary, custom_id="extra"
-    )
-    async def third_button_callback(self, button, interaction):
-        embed = discord.Embed(
-            title="Chosen Plan",
-            color=discord.Color.blue(),
-        )
-        embed.add_field(
-            name=plans[2]["name"],
-            value=(
-                f"Price: ${plans[2]['price']}\n"
-                f"Concurrent Streams: {plans[2]['concurrent_streams']}\n"
-                f"Downloads Enabled: {'Yes*' if plans[2]['downloads_enabled'] else 'No'}\n"
-                f"4K Enabled: {'Yes' if plans[2]['4k_enabled'] else 'No'}\n"
-            ),
-            inline=False,
-        )
-        if plans[2]["downloads_enabled"]:
-            embed.add_field(
-                name="",
-                value="*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/.",
-                inline=False,
+    @property
+    def timeout(self):
+        return None
+
+    @timeout.setter
+    def timeout(self, value):
+        pass
+
+
+class PlanView(PersistentView):
+    def __init__(self, registry):
+        super().__init__()
+        plans = registry.plans
+        if len(plans) <= 5:
+            for plan in plans:
+                button = discord.ui.Button(
+                    label=plan["name"],
+                    row=0,
+                    style=discord.ButtonStyle.primary,
+                    custom_id=registry.key(plan),
+                )
+                button.callback = self.plan_button_callback
+                self.add_item(button)
+        else:
+            # Buttons only fit five to a row, use select menus of up to 25 plans instead
+            for page, first in enumerate(range(0, len(plans), PLANS_PER_SELECT)):
+                page_plans = plans[first : first + PLANS_PER_SELECT]
+                select = discord.ui.Select(
+                    custom_id=f"plan_select:{page}",
+                    placeholder=f"Choose a plan ({page_plans[0]['name']} - {page_plans[-1]['name']})",
+                    row=page,
+                    options=[
+                        discord.SelectOption(
+                            label=plan["name"],
+                            value=registry.key(plan),
+                            description=f"${plan['price']}",
+                        )
+                        for plan in page_plans
+                    ],
+                )
+                select.callback = self.plan_select_callback
+                self.add_item(select)
+
+    @timed("button", "plan")
+    async def plan_button_callback(self, interaction):
+        await self.send_plan(interaction, interaction.data["custom_id"])
+
+    @timed("select", "plan")
+    async def plan_select_callback(self, interaction):
+        await self.send_plan(interaction, interaction.data["values"][0])
+
+    async def send_plan(self, interaction, key):
+        # Look the plan up at click time so old messages follow plans.yml reloads
+        registry = plan_registry
+        plan = registry.by_key.get(key)
+        if plan is None:
+            await interaction.response.send_message(
+                "This plan is no longer available.", ephemeral=True
             )
+            return
         await interaction.response.send_message(
-            embed=embed, view=PaymentOptionsView(plan=plans[2]), ephemeral=True
+            embed=registry.chosen_embeds[plan["name"]],
+            view=payment_views[key],
+            ephemeral=True,
         )
 
     @discord.ui.button(
         label="Complete Payment",
-        row=1,
+        row=4,
         style=discord.ButtonStyle.green,
         custom_id="complete_payment",
     )
+    @timed("button", "complete_payment")
     async def fourth_button_callback(self, button, interaction):
-        compelte = await complete_payment(interaction.user.id)
-        await interaction.response.send_message(compelte, ephemeral=True)
+        await interactions.run(
+            interaction, lambda: complete_payment(interaction.user.id), group="payment"
+        )
 
     @discord.ui.button(
         label="Cancel Payment",
-        row=1,
+        row=4,
         style=discord.ButtonStyle.red,
         custom_id="cancel_payment",
     )
+    @timed("button", "cancel_payment")
     async def fifth_button_callback(self, button, interaction):
-        await interaction.response.send_message(
-            await cancel_payment(interaction.user.id), ephemeral=True
+        await interactions.run(
+            interaction, lambda: cancel_payment(interaction.user.id), group="payment"
         )
 
 
-class PaymentOptionsView(discord.ui.View):
-    def __init__(self, plan):
-        super().__init__(timeout=None)
+class PaymentOptionsView(PersistentView):
+    def __init__(self, plan, key):
+        super().__init__()
         self.plan = plan
-        print(self.plan["onetime_stripe_price_id"])
+        button = discord.ui.Button(
+            label="One Time",
+            row=0,
+            style=discord.ButtonStyle.primary,
+            custom_id=f"one-time:{key}",
+        )
+        button.callback = self.first_button_callback
+        self.add_item(button)
 
-    @discord.ui.button(
-        label="One Time", row=0, style=discord.ButtonStyle.primary, custom_id="one-time"
-    )
-    async def first_button_callback(self, button, interaction):
-        count = await db_plex["plex"].count_documents({})
-        if count == 100:
+    @timed("button", "one_time")
+    async def first_button_callback(self, interaction):
+        if await server_pool.is_full(interaction.user.id, self.plan):
             await interaction.response.send_message(
                 "The server is currently full. Please try again later.", ephemeral=True
             )
@@ -572,7 +917,7 @@ class PaymentOptionsView(discord.ui.View):
         await interaction.response.send_modal(
             EmailModal(
                 title="One Time Payment",
-                plan=self.plan["onetime_stripe_price_id"],
+                plan=self.plan["stripe_price_id"],
                 plan_name=self.plan["name"],
             )
         )
@@ -587,43 +932,57 @@ async def migrate(ctx):
             ephemeral=True,
         )
         return
+    await interactions.run(
+        ctx.interaction, lambda: migrateSubscriber(record), group="plex"
+    )
+
+
+async def migrateSubscriber(record):
+    plan = record["plan_name"]
+    selected_plan = plan_registry.get(plan)
+    if selected_plan is None:
+        return f"Your plan {plan} is no longer offered. Please contact an admin."
+    pool_server = server_pool.get(record.get("server"))
+    if pool_server is not None and not pool_server.sections_loaded:
+        # Without its sections a server can't be told apart from one lacking 4K
+        return "Your server is still connecting, please try again in a few minutes."
+    if pool_server is not None and server_pool.serves(pool_server, selected_plan):
+        try:
+            await sharePlex(record["email"], plan, pool_server)
+        except Exception as e:
+            return f"There was an error migrating your account. Please contact an admin. Error: {e}"
     else:
-        selected_plan = next(
-            (plan for plan in plans if plan["name"] == record["plan_name"]), None
-        )
-        downloads_enabled = selected_plan["downloads_enabled"]
-        enabled_4k = selected_plan["4k_enabled"]
-        if enabled_4k:
-            add_sections = sections_all
-        else:
-            add_sections = sections_standard
+        # Their server left the pool or lacks the plan's sections, move them
+        new_server = await server_pool.place(record["discord_id"], selected_plan)
+        if new_server is None:
+            return "There is no room on the servers for your plan right now. Please try again later."
         try:
-            plex.myPlexAccount().inviteFriend(
-                record["email"],
-                plex,
-                allowSync=downloads_enabled,
-                sections=add_sections,
-            )
+            await sharePlex(record["email"], plan, new_server)
         except Exception as e:
-            await ctx.respond(
-                f"There was an error migrating your account. Please contact an admin. Error: {e}",
-                ephemeral=True,
-            )
-            return
-        plan = record["plan_name"]
-        # add role to user
-        role_id = next(item for item in plans if item["name"] == plan)["role_id"]
-        role = discord.utils.get(bot.get_guild(int(GUILD_ID)).roles, id=int(role_id))
-        await bot.get_guild(int(GUILD_ID)).get_member(record["discord_id"]).add_roles(
-            role
+            await server_pool.release(record["discord_id"])
+            return f"There was an error migrating your account. Please contact an admin. Error: {e}"
+        await new_server.capacity.join(record["discord_id"])
+        await db_plex["plex"].update_one(
+            {"_id": record["_id"]}, {"$set": {"server": new_server.name}}
         )
-        expiration_date = record["expiration_date"]
-        days_remaining = (expiration_date - datetime.datetime.now()).days
+        if pool_server is not None:
+            await pool_server.capacity.leave()
+            try:
+                # Only this server's share, the account may own the new server too
+                await pool_server.roster.remove_share(record["email"])
+            except Exception as e:
+                contactAdmin(
+                    f'Failed to remove {record["email"]} from {pool_server.name}: {e}',
+                    kind="plex_failed",
+                )
+    # add role to user
+    role_id = selected_plan["role_id"]
+    role = discord.utils.get(bot.get_guild(int(GUILD_ID)).roles, id=int(role_id))
+    await bot.get_guild(int(GUILD_ID)).get_member(record["discord_id"]).add_roles(role)
+    expiration_date = record["expiration_date"]
+    days_remaining = (expiration_date - datetime.datetime.now()).days
 
-        await ctx.respond(
-            f"Your account has been migrated to {plan}, and expires in {days_remaining}. Please check your email for an invite to the new server.",
-            ephemeral=True,
-        )
+    return f"Your account has been migrated to {plan}, and expires in {days_remaining}. Please check your email for an invite to the new server."
 
 
 @bot.slash_command(guild_ids=[GUILD_ID])
@@ -633,43 +992,51 @@ async def send_plan_menu(ctx):
             "You do not have permission to use this command.", ephemeral=True
         )
         return
-    embed = discord.Embed(
-        title="Plex Plans",
-        description="Choose the plan that best suits your needs:",
-        color=discord.Color.blue(),
-    )
-    for plan in plans:
-        embed.add_field(
-            name=plan["name"],
-            value=(
-                f"Price: ${plan['price']}\n"
-                f"Concurrent Streams: {plan['concurrent_streams']}\n"
-                f"Downloads Enabled: {'Yes*' if plan['downloads_enabled'] else 'No'}\n"
-                f"4K Enabled: {'Yes' if plan['4k_enabled'] else 'No'}\n"
-            ),
-            inline=True,
-        )
+    embed = plan_registry.menu_embed
 
-    embed.add_field(
-        name="One Time Payment Plan",
-        value="Your card details are not saved, you will need to manually add more time to avoid being removed.",
-        inline=False,
-    )
-
-    embed.add_field(
-        name="",
-        value="*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/.",
-        inline=False,
-    )
-
-    await ctx.send(embed=embed, view=PlanView())
+    await ctx.send(embed=embed, view=plan_view)
 
     await ctx.respond(
-        f"Sent the embed, persistent status: {PlanView.is_persistent(PlanView())}",
+        f"Sent the embed, persistent status: {plan_view.is_persistent()}",
         ephemeral=True,
     )
 
 
+@bot.slash_command(description="Search the Plex library", guild_ids=[GUILD_ID])
+async def search(
+    ctx,
+    query: discord.Option(
+        discord.SlashCommandOptionType.string,
+        description="A title, optionally with its year.",
+    ),
+):
+    # Answered from the local index, Plex is never queried
+    if await library_index.built_at() is None:
+        await ctx.respond(
+            "The library is still being indexed, try again in a few minutes.",
+            ephemeral=True,
+        )
+        return
+    results = await library_index.search(query)
+    if not results:
+        await ctx.respond(
+            f"Nothing found for **{discord.utils.escape_markdown(query)}**."
+        )
+        return
+    lines = []
+    for result in results:
+        line = f"**{discord.utils.escape_markdown(result['title'])}**"
+        if result["year"]:
+            line += f" ({result['year']})"
+        if result["type"] == "show":
+            seasons = result["seasons"] or 0
+            line += f" - TV, {seasons} season{'s' if seasons != 1 else ''}"
+        else:
+            line += " - Movie"
+        lines.append(line)
+    await ctx.respond("\n".join(lines))
+
+
 @bot.slash_command(guild_ids=[GUILD_ID])
 async def ping(ctx):
     # round latency to 2 decimal places
@@ -688,34 +1055,45 @@ async def cancel_payment(discord_id):
         invoice_id = existing_payment["invoice_id"]
 
         # Retrieve the invoice from Stripe
-        invoice = await stripe.Invoice.retrieve(invoice_id)
+        paid, _ = await retrieve_payment(existing_payment)
 
         # Check if the invoice is already paid
-        if invoice.status == "paid":
+        if paid:
             return "The invoice has already been paid. If you want a refund, please contact The Governor. Please use the complete button to complete the process."
 
         # Cancel the invoice
-        await stripe.Invoice.void_invoice(invoice_id)
+        await void_payment(existing_payment)
 
         # Remove the invoice from the "payments" MongoDB collection
         await db_payments["payments"].delete_one(
             {"discord_id": discord_id, "invoice_id": invoice_id}
         )
+        await server_pool.release(discord_id)
         return "The invoice has been cancelled."
 
     except Exception as e:
         return f"Error cancelling your invoice, {e}"
 
 
-async def contactAdmin(message):
-    admin = bot.get_user(int(DISCORD_ADMIN_ID))
-    if admin is not None:
-        try:
-            await admin.send(message)
-        except discord.Forbidden:
-            print("The bot does not have permission to send messages to the admin.")
-    else:
-        print("Admin not found.")
+# Queues the message for the next admin digest, urgent messages are sent right away.
+# Never waits on Discord, so it is safe to call from hot paths.
+def contactAdmin(message, kind="info", urgent=False):
+    admin_notifier.notify(message, kind=kind, urgent=urgent)
+
+
+def reportStall(stall):
+    print(
+        f"Event loop blocked for {stall.duration:.2f}s by {stall.operation}:\n"
+        + "".join(stall.stack)
+    )
+    # The last frame is usually the blocking call itself
+    where = stall.stack[-1].strip().splitlines()[0] if stall.stack else "unknown"
+    contactAdmin(
+        f"Blocked {stall.duration:.2f}s in {stall.operation} at {where}", kind="stall"
+    )
+
+
+loop_monitor = LoopMonitor(LOOP_STALL_MS / 1000, on_stall=reportStall)
 
 
 async def complete_payment(discord_id):
@@ -724,18 +1102,73 @@ async def complete_payment(discord_id):
             {"discord_id": discord_id, "paid": False, "active": True}
         )
         if not payment_data:
+            # The webhook may already have completed it, show that result once
+            completed = await db_payments["payments"].find_one_and_update(
+                {"discord_id": discord_id, "paid": True, "result_seen": False},
+                {"$set": {"result_seen": True}},
+                sort=[("_id", -1)],
+            )
+            if completed:
+                return completed["result"]
             return "No pending payment found."
-        invoice_id = payment_data["invoice_id"]
-        invoice = await stripe.Invoice.retrieve(invoice_id)
+        if STRIPE_WEBHOOK_SECRET:
+            # Payments are applied by the Stripe webhook, no need to ask Stripe here
+            return "The invoice has not been paid yet. Once it is paid it will be applied automatically."
+        paid, customer_id = await retrieve_payment(payment_data)
 
-        if invoice.status != "paid":
+        if not paid:
             return "The invoice has not been paid yet."
 
-        # Update payment status in the database
-        await db_payments["payments"].update_one(
-            {"discord_id": discord_id, "invoice_id": invoice_id},
-            {"$set": {"paid": True, "active": False}},
+        return await fulfilPayment(
+            payment_data, result_seen=True, customer_id=customer_id
         )
+    except Exception as e:
+        return f"Error, please contact an administrator. Error: {e}"
+
+
+async def fulfilPayment(payment_data, result_seen=False, customer_id=None):
+    claimed = await claimPayment(payment_data, customer_id)
+    if claimed is None:
+        existing = await db_payments["payments"].find_one(
+            {"invoice_id": payment_data["invoice_id"]}
+        )
+        return existing.get(
+            "result",
+            "Your payment is being applied, you will get a message once it is done.",
+        )
+    return await grantPayment(claimed, result_seen)
+
+
+async def claimPayment(payment_data, customer_id=None):
+    # Checkout Sessions only know their customer once paid, keep it for next time
+    update = {"paid": True, "active": False}
+    if customer_id:
+        update["stripe_customer_id"] = customer_id
+    # Atomically claim the payment so the webhook and a button click can't both apply it
+    claimed = await db_payments["payments"].find_one_and_update(
+        {"invoice_id": payment_data["invoice_id"], "paid": False},
+        {"$set": update},
+    )
+    if claimed is not None:
+        claimed.update(update)
+    return claimed
+
+
+async def grantPayment(claimed, result_seen=False):
+    result = await applyPayment(claimed)
+    await db_payments["payments"].update_one(
+        {"invoice_id": claimed["invoice_id"]},
+        {"$set": {"result": result, "result_seen": result_seen}},
+    )
+    return result
+
+
+async def applyPayment(payment_data):
+    discord_id = payment_data["discord_id"]
+    customer = {}
+    if payment_data.get("stripe_customer_id"):
+        customer["stripe_customer_id"] = payment_data["stripe_customer_id"]
+    try:
         # Add user to Plex
         user_email = payment_data["email"]
         plex_test = await db_plex["plex"].find_one({"email": user_email})
@@ -745,23 +1178,40 @@ async def complete_payment(discord_id):
             expiration_date = current_expiry + datetime.timedelta(days=30)
             await db_plex["plex"].update_one(
                 {"email": user_email},
-                {
-                    "$set": {
-                        "expiration_date": expiration_date,
-                        "sent_notifications": [],
-                    }
-                },
+                {"$set": {"expiration_date": expiration_date, **customer}},
             )
+            expiry_scheduler.schedule(plex_test["discord_id"], expiration_date)
 
             return "Time was added to your account."
+        selected_plan = plan_registry.get(payment_data["plan_name"])
+        if selected_plan is None:
+            # Reloads keep plans with open invoices, this is a plan removed by a restart
+            await server_pool.release(discord_id)
+            contactAdmin(
+                f'{discord_id} paid {payment_data["invoice_id"]} for plan {payment_data["plan_name"]}, which is no longer in {PLANS_FILE}.',
+                urgent=True,
+            )
+            return "Payment verified, but your plan is no longer offered. An administrator has been notified and will contact you."
+        # The server reserved when the invoice was created, payments from before the
+        # pool have none and go to the least loaded server
+        pool_server = None
+        if payment_data.get("server"):
+            pool_server = server_pool.get(payment_data["server"])
+        if pool_server is None:
+            pool_server = (
+                await server_pool.ranked(selected_plan) or [server_pool.primary]
+            )[0]
         try:
             add_to_plex_result = await add_to_plex(
-                user_email, discord_id, payment_data["plan_name"]
+                user_email, discord_id, payment_data["plan_name"], pool_server
             )
             if add_to_plex_result != True:
+                await server_pool.release(discord_id)
                 return f"Payment verified, but there was an error adding you to Plex. Please contact an administrator. Error: {add_to_plex_result}"
         except Exception as e:
+            await server_pool.release(discord_id)
             return f"Payment verified, but there was an error adding you to Plex. Please contact an administrator. Error: {e}"
+        await pool_server.capacity.join(discord_id)
         expiration_date = datetime.datetime.utcnow() + datetime.timedelta(days=30)
         await db_plex["plex"].update_one(
             {"email": user_email},
@@ -770,13 +1220,13 @@ async def complete_payment(discord_id):
                     "expiration_date": expiration_date,
                     "plan_id": payment_data["plan_id"],
                     "plan_name": payment_data["plan_name"],
-                    "sent_notifications": [],
+                    **customer,
                 }
             },
         )
-        plan = payment_data["plan_name"]
-        # find the role id in plans list from the plan name
-        role_id = next(item for item in plans if item["name"] == plan)["role_id"]
+        expiry_scheduler.schedule(discord_id, expiration_date)
+        # find the role id in the plan registry from the plan name
+        role_id = selected_plan["role_id"]
         role = discord.utils.get(bot.get_guild(int(GUILD_ID)).roles, id=int(role_id))
         await bot.get_guild(int(GUILD_ID)).get_member(discord_id).add_roles(role)
         return "Payment verified! You have been added to Plex."
@@ -784,145 +1234,496 @@ async def complete_payment(discord_id):
         return f"Error, please contact an administrator. Error: {e}"
 
 
+# Handles both invoices and Checkout Sessions, their IDs are stored as invoice_id
+async def onPaymentPaid(event):
+    invoice = event["data"]["object"]
+    if invoice["object"] == "checkout.session" and invoice["payment_status"] != "paid":
+        return  # delayed payment methods complete later with async_payment_succeeded
+    payment_data = await db_payments["payments"].find_one({"invoice_id": invoice["id"]})
+    if payment_data is None or payment_data["paid"]:
+        return  # not one of ours, or a redelivery of an event we already applied
+    claimed = await claimPayment(payment_data, customer_id=invoice.get("customer"))
+    if claimed is None:
+        return
+    # Stripe only waits seconds for an answer, adding them to Plex can take minutes
+    startTask(deliverPayment(claimed))
+
+
+async def deliverPayment(claimed):
+    result = await grantPayment(claimed)
+    await sendPaymentResult(claimed, result)
+
+
+async def onPaymentVoided(event):
+    await deactivatePayment(event["data"]["object"]["id"])
+
+
+async def sendPaymentResult(payment_data, result):
+    try:
+        user = await bot.fetch_user(int(payment_data["discord_id"]))
+        await user.send(result)
+        await db_payments["payments"].update_one(
+            {"invoice_id": payment_data["invoice_id"]}, {"$set": {"result_seen": True}}
+        )
+    except Exception:
+        pass  # they will see the result when they press Complete Payment
+
+
+async def deactivatePayment(invoice_id):
+    # The invoice or session can no longer be paid, free the user to buy again
+    await db_payments["payments"].update_one(
+        {"invoice_id": invoice_id, "paid": False},
+        {"$set": {"active": False}},
+    )
+    payment_data = await db_payments["payments"].find_one({"invoice_id": invoice_id})
+    if payment_data is not None and not payment_data["paid"]:
+        await server_pool.release(payment_data["discord_id"])
+
+
+async def sendDirectMessage(discord_id, content):
+    user = bot.get_user(int(discord_id)) or await bot.fetch_user(int(discord_id))
+    await user.send(content)
+
+
+def onMessageFailed(message, error):
+    contactAdmin(
+        f'Failed to message {message["discord_id"]}: {error}. User left server?',
+        kind="dm_failed",
+    )
+
+
+outbox = Outbox(
+    db_plex["outbox"],
+    sendDirectMessage,
+    on_failed=onMessageFailed,
+    workers=OUTBOX_WORKERS,
+)
+
+
 async def isExpired(date):
     expired = date < datetime.datetime.utcnow()
     remaining = date - datetime.datetime.utcnow()
     return expired, math.ceil(remaining.total_seconds() / 86400)
 
 
-@tasks.loop(hours=12)
+def expiryWindows(now):
+    # Only users that are expired, or whose remaining days (rounded up) is one of
+    # NOTIFICATION_DAYS, need any action. Warnings already queued are dropped by the outbox
+    windows = [{"expiration_date": {"$lt": now}}]
+    for days in NOTIFICATION_DAYS:
+        windows.append(
+            {
+                "expiration_date": {
+                    "$gt": now + datetime.timedelta(days=days - 1),
+                    "$lte": now + datetime.timedelta(days=days),
+                },
+            }
+        )
+    return {"$or": windows}
+
+
+async def expireSubscriber(user):
+    # Claim the removal so the scheduler and the reconciliation pass can't both run it
+    claimed = await db_plex["plex"].find_one_and_delete(
+        {
+            "discord_id": user["discord_id"],
+            "expiration_date": {"$lt": datetime.datetime.utcnow()},
+        }
+    )
+    if claimed is None:
+        return False
+    pool_server = server_pool.get(claimed.get("server"))
+    contactAdmin(f'{user["discord_id"]}\'s subscription has expired.', kind="expired")
+    email = user["email"]
+    plan = user["plan_name"]
+    discord_id = user["discord_id"]
+    if pool_server is None:
+        contactAdmin(
+            f'Could not remove {email} from Plex, server {claimed["server"]} is no longer in the pool',
+            kind="plex_failed",
+        )
+    else:
+        await pool_server.capacity.leave()
+        try:
+            if not await pool_server.roster.remove(email):
+                print(f"{email} had no share or pending invite to remove")
+        except Exception as e:
+            contactAdmin(
+                f"Failed to remove {email} from {pool_server.name}: {e}",
+                kind="plex_failed",
+            )
+    # give user the role according to their plan
+
+    # find the role id in the plan registry from the plan name
+    selected_plan = plan_registry.get(plan)
+    if selected_plan is None:
+        # The plan was removed from plans.yml, the rest of the expiry still has to happen
+        contactAdmin(
+            f'Could not remove the role from {user["discord_id"]}, plan {plan} no longer exists.',
+            kind="role_failed",
+        )
+    else:
+        role = discord.utils.get(
+            bot.get_guild(int(GUILD_ID)).roles, id=int(selected_plan["role_id"])
+        )
+        # remove role
+        try:
+            await bot.get_guild(int(GUILD_ID)).get_member(
+                int(user["discord_id"])
+            ).remove_roles(role)
+        except:
+            contactAdmin(
+                f'Failed to remove role from {user["discord_id"]}. User left server?',
+                kind="role_failed",
+            )
+    # message user
+    await outbox.enqueue(
+        expired_key(discord_id, claimed["expiration_date"]),
+        discord_id,
+        "Your subscription has expired. You have been removed from the server.",
+    )
+    return True
+
+
+async def warnSubscriber(user, days_remaining):
+    # The key makes this a no-op if the warning was already queued or sent
+    await outbox.enqueue(
+        warning_key(user["discord_id"], user["expiration_date"], days_remaining),
+        user["discord_id"],
+        f"Your subscription will expire in {days_remaining} days. Please renew it to avoid being removed.",
+    )
+
+
+async def checkSubscriber(user):
+    expired_check = await isExpired(user["expiration_date"])
+    expired = expired_check[0]
+    remaining = expired_check[1]
+
+    if expired:
+        return await expireSubscriber(user)
+    days_remaining = remaining
+    if days_remaining in NOTIFICATION_DAYS:
+        await warnSubscriber(user, days_remaining)
+    return False
+
+
+expiry_scheduler = ExpiryScheduler(
+    db_plex["plex"],
+    on_expire=expireSubscriber,
+    on_warning=warnSubscriber,
+    warning_days=NOTIFICATION_DAYS,
+    concurrency=CHECKER_CONCURRENCY,
+)
+
+
+# Expiry and warnings are fired on time by expiry_scheduler, this is only a
+# reconciliation pass that catches anything missed and refreshes the queue
+@tasks.loop(hours=24)
+@timed("job")
+@job_profiler.profile
 async def subscriptionCheckerLoop():
     print("Running subscription checker loop...")
     expired_removed = 0
-    await contactAdmin("Starting subscription checker loop...")
-    users = await db_plex["plex"].find().to_list(length=None)
-    for user in users:
-        expired_check = await isExpired(user["expiration_date"])
-        expired = expired_check[0]
-        remaining = expired_check[1]
-
-        if expired:
-            await contactAdmin(f'{user["discord_id"]}\'s subscription has expired.')
-            email = user["email"]
-            plan = user["plan_name"]
-            discord_id = user["discord_id"]
-            await db_plex["plex"].delete_one({"discord_id": user["discord_id"]})
-            expired_removed += 1
-            try:
-                plex.myPlexAccount().removeFriend(email)
-            except:
-                try:
-                    plex.myPlexAccount().cancelInvite(email)
-                except:
-                    pass
-            # give user the role according to their plan
-
-            # find the role id in plans list from the plan name
-            role_id = next(item for item in plans if item["name"] == plan)["role_id"]
-            role = discord.utils.get(
-                bot.get_guild(int(GUILD_ID)).roles, id=int(role_id)
+    contactAdmin("Starting subscription checker loop...", kind="checker")
+    semaphore = asyncio.Semaphore(CHECKER_CONCURRENCY)
+
+    async def check(user):
+        async with semaphore:
+            return await checkSubscriber(user)
+
+    def removed(results):
+        # One failing subscriber must not stop the loop, py-cord ends it on an exception
+        count = 0
+        for result in results:
+            if isinstance(result, Exception):
+                contactAdmin(f"Error checking a subscriber: {result}", kind="error")
+            else:
+                count += result
+        return count
+
+    cursor = db_plex["plex"].find(
+        expiryWindows(datetime.datetime.utcnow()), batch_size=CHECKER_BATCH_SIZE
+    )
+    batch = []
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) >= CHECKER_BATCH_SIZE:
+            expired_removed += removed(
+                await asyncio.gather(*map(check, batch), return_exceptions=True)
             )
-            # remove role
-            try:
-                await bot.get_guild(int(GUILD_ID)).get_member(
-                    int(user["discord_id"])
-                ).remove_roles(role)
-            except:
-                await contactAdmin(
-                    f'Failed to remove role from {user["discord_id"]}. User left server?'
-                )
-            # message user
-            try:
-                await bot.get_guild(int(GUILD_ID)).get_member(int(discord_id)).send(
-                    f"Your subscription has expired. You have been removed from the server."
-                )
-            except:
-                await contactAdmin(
-                    f'Failed to message {user["discord_id"]}. User left server?'
-                )
-        else:
-            days_remaining = remaining
-            if (
-                days_remaining in [5, 3, 1]
-                and days_remaining not in user["sent_notifications"]
-            ):
-                # add the days_remaining to the list sent_notifications
-                await db_plex["plex"].update_one(
-                    {"discord_id": user["discord_id"]},
-                    {"$push": {"sent_notifications": days_remaining}},
-                )
-                try:
-                    await bot.get_guild(int(GUILD_ID)).get_member(
-                        int(user["discord_id"])
-                    ).send(
-                        f"Your subscription will expire in {days_remaining} days. Please renew it to avoid being removed."
-                    )
-                except:
-                    await contactAdmin(
-                        f'Failed to message {user["discord_id"]}. User left server?'
-                    )
-    await contactAdmin(
-        f"Subscription checker loop completed, sleeping for 12 hours. Removed {expired_removed} expired users."
+            batch = []
+    if batch:
+        expired_removed += removed(
+            await asyncio.gather(*map(check, batch), return_exceptions=True)
+        )
+    queued = await expiry_scheduler.load()
+    # Correct any drift in the capacity counters
+    await syncCapacity()
+    contactAdmin(
+        f"Subscription checker loop completed, sleeping for 24 hours. Removed {expired_removed} expired users, {queued} deadlines scheduled.",
+        kind="checker",
     )
     return
 
 
-@tasks.loop(hours=12)
-async def stats_update():
+# Library counts follow Plex alerts, this full recount only verifies them
+@tasks.loop(hours=6)
+@timed("job")
+async def libraryRecountLoop():
     try:
-        movie_count = 0
-        tv_count = 0
-        episodes_count = 0
-        for movie_section in sections_movies:
-            movie_count += movie_section.totalSize
+        drift = await library_stats.recount()
+        if drift:
+            print(f"Library counts drifted from the alert stream: {drift}")
+        # The websocket thread exits when the connection drops
+        if not library_stats.listening():
+            # Changes were missed while disconnected
+            media_resolver.clear()
+            startTask(indexLibrary())
+        library_stats.start()
+    except Exception as e:
+        contactAdmin(f"Error recounting the Plex library: {e}", kind="error")
 
-        for tv_section in sections_tv:
-            tv_count += tv_section.totalSize
-            episodes_count += tv_section.totalViewSize(libtype="episode")
+
+async def expireReservation(pool_server, discord_id):
+    # The invoice can't stay payable without its slot, or more could pay than fit
+    payment_data = await db_payments["payments"].find_one(
+        {"discord_id": discord_id, "paid": False, "active": True}
+    )
+    if payment_data is not None:
+        try:
+            await void_payment(payment_data)
+        except Exception as e:
+            # Most likely paid meanwhile, the payment reconciliation applies it
+            print(
+                f'Could not cancel {payment_data["invoice_id"]} for its expired slot: {e}'
+            )
+            return False
+        await deactivatePayment(payment_data["invoice_id"])
+        await outbox.enqueue(
+            cancelled_key(payment_data["invoice_id"]),
+            discord_id,
+            "Your invoice was not paid in time and has been cancelled. Please subscribe again if you still want to join.",
+        )
+    await pool_server.capacity.release(discord_id)
+    return True
+
+
+@tasks.loop(minutes=5)
+@timed("job")
+async def capacityLoop():
+    for pool_server in server_pool:
+        try:
+            released = 0
+            for discord_id in await pool_server.capacity.expired():
+                released += await expireReservation(pool_server, discord_id)
+            if released:
+                print(
+                    f"Released {released} expired capacity reservations on {pool_server.name}"
+                )
+        except Exception as e:
+            print(f"Failed to expire capacity reservations on {pool_server.name}: {e}")
+
+
+# Resolves pending payments without a button click or webhook, and cancels abandoned ones
+@tasks.loop(minutes=15)
+@timed("job")
+async def paymentReconcileLoop():
+    pending = (
+        await db_payments["payments"]
+        .find({"paid": False, "active": True})
+        .to_list(None)
+    )
+    if not pending:
+        return
+    stale_before = datetime.datetime.utcnow() - datetime.timedelta(
+        hours=PAYMENT_EXPIRY_HOURS
+    )
+    try:
+        paid, stale = await sweep_payments(pending, stale_before)
+    except Exception as e:
+        contactAdmin(f"Error reconciling Stripe payments: {e}", kind="error")
+        return
+    for payment_data, customer_id in paid:
+        result = await fulfilPayment(payment_data, customer_id=customer_id)
+        await sendPaymentResult(payment_data, result)
+    for payment_data in stale:
+        await deactivatePayment(payment_data["invoice_id"])
+    if paid or stale:
+        print(
+            f"Payment reconciliation: {len(paid)} completed, {len(stale)} cancelled of {len(pending)} pending"
+        )
+
+
+@tasks.loop(seconds=30)
+@timed("job")
+async def plansReloadLoop():
+    global plan_registry, plans_checked_mtime
+    try:
+        mtime = os.stat(PLANS_FILE).st_mtime
+    except OSError:
+        return
+    if mtime in (plan_registry.mtime, plans_checked_mtime):
+        return
+    plans_checked_mtime = mtime
+    try:
+        # Build the whole registry first, handlers keep using the old one until the swap
+        registry = load_plan_registry(PLANS_FILE)
+        # Subscribers keep their plan until they expire and open invoices can still be
+        # paid, neither plan can go away under them
+        in_use = set(await db_plex["plex"].distinct("plan_name"))
+        in_use |= set(
+            await db_payments["payments"].distinct("plan_name", {"active": True})
+        )
+        dropped = sorted(name for name in in_use if name and registry.get(name) is None)
+        if dropped:
+            raise ValueError(
+                f"plans still used by subscribers or open invoices: {', '.join(dropped)}"
+            )
+    except Exception as e:
+        # Keep serving the previous plans until the file is fixed
+        contactAdmin(
+            f"Failed to reload {PLANS_FILE}, keeping the old plans: {e}", urgent=True
+        )
+        return
+    plan_registry = registry
+    installPlanViews(plan_registry)
+    print(f"Reloaded {len(plan_registry.plans)} plans from {PLANS_FILE}")
+    contactAdmin(f"Reloaded plans from {PLANS_FILE}.")
+
+
+@tasks.loop(minutes=30)
+@timed("job")
+async def rosterRefreshLoop():
+    for pool_server in server_pool:
+        try:
+            await pool_server.roster.refresh()
+        except Exception as e:
+            print(f"Failed to refresh the roster of {pool_server.name}: {e}")
+
+
+async def reconcileRoster():
+    missing = []
+    unknown = []
+    invited = removed = 0
+    errors = []
+    for pool_server in server_pool:
+        results = await reconcileServerRoster(pool_server)
+        if len(server_pool) > 1:
+            # Name the server in the admin report
+            results = (
+                [f"{pool_server.name}/{email}" for email in results[0]],
+                [f"{pool_server.name}/{email}" for email in results[1]],
+                results[2],
+                results[3],
+                [f"{pool_server.name}: {error}" for error in results[4]],
+            )
+        missing += results[0]
+        unknown += results[1]
+        invited += results[2]
+        removed += results[3]
+        errors += results[4]
+    return missing, unknown, invited, removed, errors
+
+
+async def reconcileServerRoster(pool_server):
+    plex_roster = pool_server.roster
+    await plex_roster.refresh()
+    subscribers = {}
+    async for user in db_plex["plex"].find(
+        server_pool.record_filter(pool_server), {"email": 1, "plan_name": 1}
+    ):
+        subscribers[user["email"].lower()] = user
+    missing, unknown = plex_roster.diff(subscribers)
+    missing = sorted(missing)
+    unknown = sorted(unknown - PLEX_ROSTER_IGNORE)
+
+    invited = removed = 0
+    errors = []
+    for i in range(0, len(missing), ROSTER_BATCH_SIZE):
+        batch = missing[i : i + ROSTER_BATCH_SIZE]
+        results = await asyncio.gather(
+            *(
+                sharePlex(
+                    subscribers[email]["email"],
+                    subscribers[email]["plan_name"],
+                    pool_server,
+                )
+                for email in batch
+            ),
+            return_exceptions=True,
+        )
+        for email, result in zip(batch, results):
+            if isinstance(result, Exception):
+                errors.append(f"invite {email}: {result}")
+            else:
+                invited += 1
+    if ROSTER_REMOVE_UNKNOWN:
+        for i in range(0, len(unknown), ROSTER_BATCH_SIZE):
+            batch = unknown[i : i + ROSTER_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(plex_roster.remove(email) for email in batch),
+                return_exceptions=True,
+            )
+            for email, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    errors.append(f"remove {email}: {result}")
+                else:
+                    removed += 1
+    return missing, unknown, invited, removed, errors
+
+
+@tasks.loop(hours=6)
+@timed("job")
+async def rosterReconcileLoop():
+    try:
+        missing, unknown, invited, removed, errors = await reconcileRoster()
+    except Exception as e:
+        contactAdmin(f"Error reconciling the Plex roster: {e}", kind="error")
+        return
+    if not missing and not unknown:
+        return
+    message = f"Roster reconciled. Re-invited {invited}/{len(missing)} subscribers without a share."
+    if ROSTER_REMOVE_UNKNOWN:
+        message += f" Removed {removed}/{len(unknown)} shares without a subscriber."
+    elif unknown:
+        message += f" Shares without a subscriber: {', '.join(unknown[:20])}"
+    if errors:
+        message += f" Errors: {'; '.join(errors[:10])}"
+    contactAdmin(message, kind="roster")
+
+
+# Counts come from library_stats and channels are only renamed on change, so this is cheap
+@tasks.loop(minutes=10)
+@timed("job")
+@job_profiler.profile
+async def stats_update():
+    try:
+        if library_stats.counts is None:
+            await library_stats.recount()
+        counts = library_stats.counts
 
         # add a comma to each count if needed
-        movie_count = "{:,}".format(movie_count)
-        tv_count = "{:,}".format(tv_count)
-        episodes_count = "{:,}".format(episodes_count)
+        movie_count = "{:,}".format(counts["movies"])
+        tv_count = "{:,}".format(counts["shows"])
+        episodes_count = "{:,}".format(counts["episodes"])
 
         # find the discord category with the STATS_CHANNEL_ID value
         stats_category = discord.utils.get(
             bot.get_guild(int(GUILD_ID)).categories, id=int(STATS_CHANNEL_ID)
         )
-        # check how many voice channels in this category
-        voice_channels = stats_category.voice_channels
-
-        if voice_channels == 0:
-            # create two channels, one for movies and one for tv shows and episodes counts
-            mc = await stats_category.create_voice_channel(name="Movies")
-            tc = await stats_category.create_voice_channel(name="TV Shows")
-            ec = await stats_category.create_voice_channel(name="Episodes")
-        else:
-            # get the channels
-            for channel in voice_channels:
-                await channel.delete()
-            mc = await stats_category.create_voice_channel(name="Movies")
-            tc = await stats_category.create_voice_channel(name="TV Shows")
-            ec = await stats_category.create_voice_channel(name="Episodes")
-        # make each voice channel not joinable
-        await mc.set_permissions(
-            bot.get_guild(int(GUILD_ID)).default_role, connect=False
-        )
-        await tc.set_permissions(
-            bot.get_guild(int(GUILD_ID)).default_role, connect=False
-        )
-        await ec.set_permissions(
-            bot.get_guild(int(GUILD_ID)).default_role, connect=False
-        )
-        # update the MC (movies) and TC (others), {count} Movies / {count} Shows | {count} Episodes
-        await mc.edit(name=f"{movie_count} Movies")
-        await tc.edit(name=f"{tv_count} Shows")
-        await ec.edit(name=f"{episodes_count} Episodes")
-        await contactAdmin(
-            f"Stats updated. Movies: {movie_count}, TV Shows: {tv_count}, Episodes: {episodes_count}"
-        )
+        await stats_channels.ensure(stats_category)
+        changed = [
+            stats_channels.update("movies", movie_count),
+            stats_channels.update("shows", tv_count),
+            stats_channels.update("episodes", episodes_count),
+        ]
+        if any(changed):
+            print(
+                f"Stats updated. Movies: {movie_count}, TV Shows: {tv_count}, Episodes: {episodes_count}"
+            )
     except Exception as e:
-        await contactAdmin(f"Error updating stats: {e}")
+        contactAdmin(f"Error updating stats: {e}", kind="error")
 
 
-bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
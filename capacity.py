@@ -0,0 +1,102 @@
+import datetime
+
+import pymongo
+
+
+class Capacity:
+    """Per-server subscriber slots kept in a counter document, updated atomically.
+
+    The counter holds `used` (subscribers on the server), `reserved` (slots held for
+    unpaid invoices) and `limit`. A slot is reserved when an invoice is created, turned
+    into a used slot when the payment completes, and released on cancel or timeout.
+    """
+
+    def __init__(self, counters, reservations, server, limit, reservation_ttl):
+        self.counters = counters
+        self.reservations = reservations
+        self.server = server
+        self.limit = limit
+        self.reservation_ttl = reservation_ttl
+
+    async def sync(self, used):
+        """Reset the counter from authoritative counts, e.g. at startup."""
+        reserved = await self.reservations.count_documents({"server": self.server})
+        await self.counters.update_one(
+            {"_id": self.server},
+            {"$set": {"used": used, "reserved": reserved, "limit": self.limit}},
+            upsert=True,
+        )
+
+    async def status(self):
+        doc = await self.counters.find_one({"_id": self.server})
+        if doc is None:
+            return {"used": 0, "reserved": 0, "limit": self.limit}
+        return doc
+
+    async def is_full(self, discord_id=None):
+        if discord_id is not None and await self.reservations.find_one(
+            {"_id": discord_id, "server": self.server}
+        ):
+            return False  # they already hold a slot
+        doc = await self.status()
+        return doc["used"] + doc["reserved"] >= doc["limit"]
+
+    async def reserve(self, discord_id):
+        """Hold a slot for discord_id, returns False if the server is full."""
+        expires_at = datetime.datetime.utcnow() + self.reservation_ttl
+        renewed = await self.reservations.update_one(
+            {"_id": discord_id, "server": self.server},
+            {"$set": {"expires_at": expires_at}},
+        )
+        if renewed.matched_count:
+            return True
+        taken = await self.counters.find_one_and_update(
+            {
+                "_id": self.server,
+                "$expr": {"$lt": [{"$add": ["$used", "$reserved"]}, "$limit"]},
+            },
+            {"$inc": {"reserved": 1}},
+        )
+        if taken is None:
+            return False
+        try:
+            await self.reservations.insert_one(
+                {"_id": discord_id, "server": self.server, "expires_at": expires_at}
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # A concurrent request from the same user got there first
+            await self.counters.update_one(
+                {"_id": self.server}, {"$inc": {"reserved": -1}}
+            )
+        return True
+
+    async def release(self, discord_id):
+        """Give back a reserved slot (invoice cancelled, voided or timed out)."""
+        deleted = await self.reservations.delete_one(
+            {"_id": discord_id, "server": self.server}
+        )
+        if deleted.deleted_count:
+            await self.counters.update_one(
+                {"_id": self.server}, {"$inc": {"reserved": -1}}
+            )
+
+    async def join(self, discord_id):
+        """Turn the user's reservation, if any, into a used slot."""
+        deleted = await self.reservations.delete_one(
+            {"_id": discord_id, "server": self.server}
+        )
+        await self.counters.update_one(
+            {"_id": self.server},
+            {"$inc": {"used": 1, "reserved": -deleted.deleted_count}},
+        )
+
+    async def leave(self):
+        await self.counters.update_one({"_id": self.server}, {"$inc": {"used": -1}})
+
+    async def expired(self):
+        """IDs of the reservations held past their TTL, release() them once handled."""
+        expired = self.reservations.find(
+            {"server": self.server, "expires_at": {"$lt": datetime.datetime.utcnow()}},
+            {"_id": 1},
+        )
+        return [reservation["_id"] async for reservation in expired]
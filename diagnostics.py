@@ -0,0 +1,226 @@
+"""Event loop stall detection and sampled profiling of the background jobs.
+
+LoopMonitor measures how late a heartbeat on the event loop wakes up. A watchdog
+thread notices when the loop has not run for longer than the threshold and grabs the
+loop thread's stack while it is still stuck, so the blocking call itself shows up, and
+the stall is attributed to the command, button or job that was running (see
+metrics.running). JobProfiler samples one job run from a thread and saves the stacks
+in the folded format flamegraph tools read.
+"""
+
+import asyncio
+import collections
+import datetime
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import observe, running
+
+# How often the heartbeat runs on the loop
+HEARTBEAT_SECONDS = 0.5
+
+# Frames above Handle._run in this file belong to the event loop, not the task
+EVENTS_FILE = asyncio.events.__file__
+
+
+def task_frames(frame):
+    """Stack of the loop thread from the running task's coroutine down, outermost first."""
+    frames = [frame for frame, _ in traceback.walk_stack(frame)][::-1]
+    # Everything up to Handle._run is the event loop itself
+    for index in range(len(frames) - 1, -1, -1):
+        code = frames[index].f_code
+        if code.co_filename == EVENTS_FILE and code.co_name == "_run":
+            return frames[index + 1 :]
+    return frames
+
+
+def awaiting_frames(task):
+    """Frames of a suspended task's await chain, outermost first."""
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+def describe(task):
+    """What a task was doing: its tracked operations, or failing that its name."""
+    if task is None:
+        return "event loop callback"
+    operations = running.get(task)
+    if operations:
+        return " > ".join(operations)
+    return f"{task.get_name()} ({task.get_coro().__qualname__})"
+
+
+class Stall:
+    def __init__(self, operation, stack):
+        self.operation = operation
+        self.stack = stack  # formatted, outermost first
+        self.duration = None  # filled in once the loop runs again
+
+
+class LoopMonitor:
+    """Reports every time the event loop is blocked for longer than `threshold` seconds.
+
+    on_stall is called on the loop with a Stall once the loop recovers.
+    """
+
+    def __init__(self, threshold=0.25, on_stall=None):
+        self.threshold = threshold
+        self.on_stall = on_stall
+        self._lock = threading.Lock()
+        self._beat = None
+        self._stall = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        threading.Thread(
+            target=self._watchdog, name="loop-watchdog", daemon=True
+        ).start()
+
+    def stop(self):
+        self._stopped.set()
+        self._heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            now = time.monotonic()
+            lag = max(now - self._beat - HEARTBEAT_SECONDS, 0)
+            observe("loop", "lag", lag)
+            with self._lock:
+                self._beat = now
+                stall, self._stall = self._stall, None
+            if stall is None:
+                continue
+            stall.duration = lag
+            observe("stall", stall.operation, lag)
+            if self.on_stall is not None:
+                try:
+                    self.on_stall(stall)
+                except Exception as e:
+                    print(f"Stall handler failed: {e}")
+
+    def _watchdog(self):
+        while not self._stopped.wait(self.threshold / 2):
+            with self._lock:
+                late = time.monotonic() - self._beat - HEARTBEAT_SECONDS
+                if late < self.threshold or self._stall is not None:
+                    continue
+                self._stall = self._capture()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.thread_id)
+        task = asyncio.current_task(self.loop)
+        stack = traceback.format_list(
+            traceback.StackSummary.extract((f, f.f_lineno) for f in task_frames(frame))
+            if frame is not None
+            else []
+        )
+        return Stall(describe(task), stack)
+
+
+class JobProfiler:
+    """Samples the stacks of a job's runs and saves each run to `directory`.
+
+    Decorate the job with `profiler.profile`. A sample is the job's stack if it holds
+    the loop at that moment, prefixed "running", or the await chain it is suspended in,
+    prefixed "waiting". Only the newest `keep` files per job are kept.
+    """
+
+    def __init__(self, directory, interval=0.01, keep=20, enabled=True):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.enabled = enabled
+
+    def profile(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return await func(*args, **kwargs)
+            sampler = Sampler(asyncio.current_task(), self.interval)
+            sampler.start()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                sampler.stop()
+                try:
+                    path = await asyncio.to_thread(self.save, func.__name__, sampler)
+                    print(
+                        f"Profiled {func.__name__}: {sampler.total} samples, "
+                        f"{sampler.busy} holding the loop, saved to {path}"
+                    )
+                except OSError as e:
+                    print(f"Could not save profile of {func.__name__}: {e}")
+
+        return wrapper
+
+    def save(self, name, sampler):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.directory, f"{name}-{stamp}.folded")
+        with open(path, "w") as file:
+            for stack, count in sampler.samples.most_common():
+                file.write(f"{stack} {count}\n")
+        runs = sorted(
+            entry
+            for entry in os.listdir(self.directory)
+            if entry.startswith(f"{name}-") and entry.endswith(".folded")
+        )
+        for old in runs[: -self.keep]:
+            os.remove(os.path.join(self.directory, old))
+        return path
+
+
+class Sampler(threading.Thread):
+    def __init__(self, task, interval):
+        super().__init__(name="job-sampler", daemon=True)
+        self.task = task
+        self.loop = task.get_loop()
+        self.thread_id = threading.get_ident()
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.total = 0
+        self.busy = 0
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if asyncio.current_task(self.loop) is self.task:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is None:
+                    continue
+                frames = task_frames(frame)
+                state = "running"
+                self.busy += 1
+            else:
+                frames = awaiting_frames(self.task)
+                state = "waiting"
+            self.total += 1
+            self.samples[";".join([state] + [_frame_name(f) for f in frames])] += 1
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # First line rather than current line, so samples of one function add up
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
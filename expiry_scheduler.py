@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+
+# Sleep at most this long between checks so clock jumps are noticed
+MAX_SLEEP = 3600
+
+
+class ExpiryScheduler:
+    """Fires expiry and warning actions at their exact deadlines from an in-memory priority queue.
+
+    Only deadlines inside `horizon` are queued; load() must be called more often than
+    `horizon` minus the largest warning day so nothing is missed.
+    """
+
+    def __init__(
+        self,
+        collection,
+        on_expire,
+        on_warning,
+        warning_days,
+        horizon=datetime.timedelta(days=7),
+        concurrency=10,
+    ):
+        self.collection = collection
+        self.on_expire = on_expire
+        self.on_warning = on_warning
+        self.warning_days = warning_days
+        self.horizon = horizon
+        self._heap = []
+        self._counter = itertools.count()
+        # discord_id -> expiration date the queued entries were built for
+        self._current = {}
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def load(self):
+        """Rebuild the queue from every subscriber whose deadlines fall inside the horizon."""
+        now = datetime.datetime.utcnow()
+        # Warnings fire before the expiry itself, so look that much further ahead
+        until = now + self.horizon + datetime.timedelta(days=max(self.warning_days))
+        cursor = self.collection.find(
+            {"expiration_date": {"$ne": None, "$lt": until}},
+            {"discord_id": 1, "expiration_date": 1},
+        )
+        self._heap = []
+        self._current = {}
+        async for user in cursor:
+            self._heap += self._push(user["discord_id"], user["expiration_date"], now)
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        return len(self._heap)
+
+    def schedule(self, discord_id, expiration_date):
+        """Queue (or requeue after an extension) the deadlines of one subscriber."""
+        now = datetime.datetime.utcnow()
+        entries = self._push(discord_id, expiration_date, now)
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+        self._wakeup.set()
+
+    def _push(self, discord_id, expiration_date, now):
+        # Older entries for this user stay in the heap but are skipped as stale when popped
+        self._current[discord_id] = expiration_date
+        entries = []
+        if expiration_date - now < self.horizon:
+            entries.append(
+                (
+                    expiration_date,
+                    next(self._counter),
+                    discord_id,
+                    expiration_date,
+                    None,
+                )
+            )
+        for days in self.warning_days:
+            when = expiration_date - datetime.timedelta(days=days)
+            if when - now >= self.horizon:
+                continue
+            if expiration_date - datetime.timedelta(days=days - 1) <= now:
+                continue  # already past this warning window
+            entries.append(
+                (when, next(self._counter), discord_id, expiration_date, days)
+            )
+        return entries
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = (self._heap[0][0] - datetime.datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=min(delay, MAX_SLEEP)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, discord_id, expiration_date, days = heapq.heappop(self._heap)
+            if self._current.get(discord_id) != expiration_date:
+                continue  # subscription was extended or removed since this was queued
+            task = asyncio.create_task(self._fire(discord_id, expiration_date, days))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, discord_id, expiration_date, days):
+        async with self._semaphore:
+            try:
+                user = await self.collection.find_one({"discord_id": discord_id})
+                # Mongo keeps millisecond precision, so compare loosely
+                if user is None or user["expiration_date"] is None:
+                    return
+                if abs(user["expiration_date"] - expiration_date).total_seconds() >= 1:
+                    return
+                if days is None:
+                    self._current.pop(discord_id, None)
+                    await self.on_expire(user)
+                else:
+                    # on_warning is idempotent, the outbox drops repeats
+                    await self.on_warning(user, days)
+            except Exception as e:
+                print(f"Expiry scheduler failed for {discord_id}: {e}")
@@ -0,0 +1,60 @@
+import asyncio
+
+import discord
+
+from metrics import track
+
+BUSY_MESSAGE = "You already have a request in progress, please wait for it to finish."
+
+
+class InteractionRunner:
+    """Acknowledges interactions straight away and finishes them in the background.
+
+    Discord fails an interaction that is not answered within 3 seconds, so run() defers
+    it first, then runs the work as a tracked task and edits the deferred response with
+    the result. Only one task per user and group runs at a time, repeated clicks while
+    one is running are told to wait.
+    """
+
+    def __init__(self):
+        self._running = {}
+
+    def __len__(self):
+        return len(self._running)
+
+    async def run(self, interaction, work, group, ephemeral=True):
+        """Defer the interaction and complete it with the result of `work()`.
+
+        work is a coroutine function returning the message to show.
+        """
+        key = (interaction.user.id, group)
+        if key in self._running:
+            await interaction.response.send_message(BUSY_MESSAGE, ephemeral=True)
+            return None
+        # Claim the slot before the first await so a double click can't slip in
+        self._running[key] = None
+        try:
+            # invisible=False shows "thinking" instead of editing the clicked message
+            await interaction.response.defer(ephemeral=ephemeral, invisible=False)
+        except discord.HTTPException:
+            del self._running[key]
+            raise
+        task = asyncio.create_task(self._complete(interaction, work, group))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+        return task
+
+    async def _complete(self, interaction, work, group):
+        try:
+            with track("interaction", group):
+                result = await work()
+        except Exception as e:
+            print(f"Interaction from {interaction.user.id} failed: {e}")
+            result = (
+                f"Something went wrong, please contact an administrator. Error: {e}"
+            )
+        try:
+            await interaction.edit_original_response(content=result)
+        except discord.HTTPException as e:
+            # The interaction token only lasts 15 minutes
+            print(f"Could not respond to interaction from {interaction.user.id}: {e}")
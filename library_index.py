@@ -0,0 +1,233 @@
+import asyncio
+import concurrent.futures
+import re
+import sqlite3
+import time
+
+# Items per section listing call while building
+PAGE_SIZE = 500
+# Library events come in bursts while Plex scans, collect them for this long
+UPDATE_DELAY = 5
+
+# Plex metadata types
+MOVIE = 1
+SHOW = 2
+SEASON = 3
+
+YEAR_PATTERN = re.compile(r"^(19|20)\d\d$")
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+    title,
+    original_title,
+    year,
+    type UNINDEXED,
+    seasons UNINDEXED,
+    section_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def row(item):
+    """Index row for a movie or show: rowid is the rating key.
+
+    Reads the loaded attributes directly, plexapi reloads the full metadata of a
+    listed item whenever an attribute it reads is None (most have no originalTitle).
+    """
+    data = vars(item)
+    return (
+        int(data["ratingKey"]),
+        data["title"],
+        data.get("originalTitle") or "",
+        data.get("year"),
+        data["type"],
+        data.get("childCount") if data["type"] == "show" else None,
+        int(data["librarySectionID"]),
+    )
+
+
+def match_query(text):
+    """FTS5 query matching every title word as a prefix, a year also on its own column."""
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        if YEAR_PATTERN.match(word):
+            # Filtered through the index rather than after matching every title word,
+            # the word may also be part of the title ("1917", "2012")
+            terms.append(f'(year : "{word}" OR {{title original_title}} : "{word}"*)')
+        else:
+            terms.append(f'{{title original_title}} : "{word}"*')
+    return " AND ".join(terms)
+
+
+class LibraryIndex:
+    """SQLite full-text index of the movie and TV sections, for searching without Plex.
+
+    build() fills it from paged section listings, after that it follows library change
+    events (wire on_change to LibraryStats.on_change). The file survives restarts, so a
+    full build is only needed the first time or after events were missed. All SQLite
+    work runs on one thread of its own.
+    """
+
+    def __init__(self, path, gateway, sections_movies, sections_tv):
+        self.path = path
+        self.gateway = gateway
+        self.sections_movies = sections_movies
+        self.sections_tv = sections_tv
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="library-index"
+        )
+        self._db = None
+        self._pending = set()
+        self._flush_task = None
+        self._building = False
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    @property
+    def db(self):
+        # Opened on first use, always from the index thread
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(SCHEMA.format(table="items"))
+        return self._db
+
+    async def built_at(self):
+        """When the last full build finished, or None if it never did."""
+        value = await self._run(self._meta, "built_at")
+        return float(value) if value else None
+
+    def _meta(self, key):
+        found = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        result = found.fetchone()
+        return result[0] if result else None
+
+    async def build(self):
+        """Rebuild from scratch into a new table and swap it in, returns the item count."""
+        # Changes arriving meanwhile are held back until the new table is in place
+        self._building = True
+        try:
+            await self._run(self._create_staging)
+            count = 0
+            for section in self.sections_movies + self.sections_tv:
+                async for rows in self._pages(section):
+                    await self._run(self._insert, "items_new", rows)
+                    count += len(rows)
+            await self._run(self._swap)
+        finally:
+            self._building = False
+        return count
+
+    async def _pages(self, section):
+        """Index rows of a section, a page at a time."""
+        start = 0
+        while True:
+            rows = await self.gateway.section_page(section, start, PAGE_SIZE, row)
+            yield rows
+            if len(rows) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+
+    def _create_staging(self):
+        self.db.execute("DROP TABLE IF EXISTS items_new")
+        self.db.executescript(SCHEMA.format(table="items_new"))
+
+    def _insert(self, table, rows):
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO {table}"
+                "(rowid, title, original_title, year, type, seasons, section_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _swap(self):
+        with self.db:
+            self.db.execute("DROP TABLE items")
+            self.db.execute("ALTER TABLE items_new RENAME TO items")
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('built_at', ?)",
+                (str(time.time()),),
+            )
+
+    async def search(self, text, limit=10):
+        """Best matches as dicts with title, type, year and seasons."""
+        query = match_query(text)
+        if not query:
+            return []
+        return await self._run(self._search, query, limit)
+
+    def _search(self, query, limit):
+        found = self.db.execute(
+            "SELECT title, type, year, seasons FROM items WHERE items MATCH ?"
+            " ORDER BY rank LIMIT ?",
+            (query, limit),
+        )
+        return [
+            {"title": title, "type": kind, "year": year, "seasons": seasons}
+            for title, kind, year, seasons in found.fetchall()
+        ]
+
+    def on_change(self, action, item_id, section_id, plex_type):
+        if plex_type not in (MOVIE, SHOW, SEASON):
+            return
+        self._pending.add((action, item_id, section_id, plex_type))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending:
+            await asyncio.sleep(UPDATE_DELAY)
+            if self._building:
+                continue
+            pending, self._pending = self._pending, set()
+            await self._update(pending)
+
+    async def _update(self, pending):
+        deleted = []
+        refresh = set()
+        recount = set()
+        for action, item_id, section_id, plex_type in pending:
+            if action != "deleted":
+                refresh.add((item_id, plex_type))
+            elif plex_type == SEASON:
+                # A deleted season can't be fetched for its show, relist the section
+                recount.add(section_id)
+            else:
+                deleted.append(item_id)
+        refresh = {(key, kind) for key, kind in refresh if key not in deleted}
+        rows = []
+        for section in self.sections_tv:
+            if int(section.key) not in recount:
+                continue
+            try:
+                async for page in self._pages(section):
+                    rows += [item for item in page if item[0] not in deleted]
+            except Exception as e:
+                print(f"Could not recount seasons in {section.title}: {e}")
+        for item_id, plex_type in refresh:
+            try:
+                item = await self.gateway.fetch_item(item_id)
+                if plex_type == SEASON:
+                    # Only the show's season count is indexed
+                    item = await self.gateway.fetch_item(item.parentRatingKey)
+                rows.append(row(item))
+            except Exception as e:
+                print(f"Could not index library item {item_id}: {e}")
+        await self._run(self._apply, deleted, rows)
+
+    def _apply(self, deleted, rows):
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM items WHERE rowid = ?", [(key,) for key in deleted]
+            )
+        self._insert("items", rows)
+
+    def close(self):
+        if self._db is not None:
+            self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,111 @@
+import asyncio
+
+LIBRARY_IDENTIFIER = "com.plexapp.plugins.library"
+# Plex metadata type -> count key
+COUNTED_TYPES = {1: "movies", 2: "shows", 4: "episodes"}
+# Timeline states, see plexapi.alert.AlertListener
+STATE_CREATED = 0
+STATE_FINISHED = 5
+STATE_DELETED = 9
+
+
+class LibraryStats:
+    """Library counts from one baseline recount, kept current by Plex's alert websocket.
+
+    Other features can subscribe to the same library events with on_change(); callbacks
+    run on the event loop with (action, item_id, section_id, plex_type), where action is
+    "added", "updated" (metadata refreshed or media changed) or "deleted".
+    """
+
+    def __init__(self, gateway, sections_movies, sections_tv):
+        self.gateway = gateway
+        self.sections_movies = sections_movies
+        self.sections_tv = sections_tv
+        self.counts = None
+        self._callbacks = []
+        self._listener = None
+        self._loop = None
+
+    @property
+    def _sections(self):
+        # The section lists are filled in place once Plex connects
+        return {int(section.key) for section in self.sections_movies + self.sections_tv}
+
+    def on_change(self, callback):
+        self._callbacks.append(callback)
+
+    async def recount(self):
+        """Count every library from scratch, returns how far the live counts had drifted."""
+        counts = {"movies": 0, "shows": 0, "episodes": 0}
+        for section in self.sections_movies:
+            counts["movies"] += await self.gateway.section_size(section)
+        for section in self.sections_tv:
+            counts["shows"] += await self.gateway.section_size(section)
+            counts["episodes"] += await self.gateway.section_size(
+                section, libtype="episode"
+            )
+        drift = {}
+        if self.counts is not None:
+            drift = {
+                key: counts[key] - self.counts[key]
+                for key in counts
+                if counts[key] != self.counts[key]
+            }
+        self.counts = counts
+        return drift
+
+    def listening(self):
+        return self._listener is not None and self._listener.is_alive()
+
+    def start(self):
+        """Start (or restart after a dropped connection) the alert listener thread."""
+        self._loop = asyncio.get_running_loop()
+        if self.listening():
+            return
+        self._listener = self.gateway.server.startAlertListener(
+            callback=self._on_alert, callbackError=self._on_error
+        )
+
+    def stop(self):
+        if self.listening():
+            self._listener.stop()
+
+    def _on_error(self, error):
+        print(f"Plex alert listener error: {error}")
+
+    def _on_alert(self, data):
+        # Runs on the listener thread, hand everything over to the event loop
+        if data.get("type") != "timeline":
+            return
+        for entry in data.get("TimelineEntry", []):
+            if entry.get("identifier") != LIBRARY_IDENTIFIER:
+                continue
+            state = entry.get("state")
+            if state == STATE_CREATED and entry.get("metadataState") == "created":
+                action = "added"
+            elif state == STATE_FINISHED:
+                action = "updated"
+            elif state == STATE_DELETED:
+                action = "deleted"
+            else:
+                continue
+            self._loop.call_soon_threadsafe(
+                self._apply,
+                action,
+                int(entry.get("itemID", 0)),
+                int(entry.get("sectionID", -1)),
+                entry.get("type"),
+            )
+
+    def _apply(self, action, item_id, section_id, plex_type):
+        if section_id not in self._sections:
+            return
+        key = COUNTED_TYPES.get(plex_type)
+        if key is not None and self.counts is not None and action != "updated":
+            delta = 1 if action == "added" else -1
+            self.counts[key] = max(0, self.counts[key] + delta)
+        for callback in self._callbacks:
+            try:
+                callback(action, item_id, section_id, plex_type)
+            except Exception as e:
+                print(f"Library change callback failed: {e}")
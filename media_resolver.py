@@ -0,0 +1,101 @@
+import asyncio
+import collections
+import re
+import time
+import urllib.parse
+
+from plexapi.exceptions import NotFound
+
+from metrics import counter
+
+# Anything carrying a library key: Plex Web and app.plex.tv links (key=%2Flibrary%2F...),
+# server URLs and bare /library/metadata/<id> paths. The key must end there, Discover
+# links carry hex ids (/library/metadata/5d776b...) that are not in the library.
+# plex://movie/<guid> links name no library item and are not accepted.
+METADATA_PATTERN = re.compile(r"/library/metadata/(\d+)(?=$|[&?#/\"])")
+RATING_KEY_PATTERN = re.compile(r"^\s*(\d+)\s*$")
+
+lookups = counter(
+    "plexbot_media_cache_lookups_total", "Media lookups by cache result (hit or miss)."
+)
+
+
+class MediaNotFound(Exception):
+    pass
+
+
+def parse_media_url(url):
+    """Rating key from a Plex media URL, deep link or a bare rating key, or None."""
+    match = RATING_KEY_PATTERN.match(url)
+    if match:
+        return int(match.group(1))
+    # Plex Web encodes the key once, links pasted through other apps may be encoded twice
+    for _ in range(3):
+        match = METADATA_PATTERN.search(url)
+        if match:
+            return int(match.group(1))
+        decoded = urllib.parse.unquote(url)
+        if decoded == url:
+            return None
+        url = decoded
+    return None
+
+
+class MediaResolver:
+    """Looks up plexapi items by rating key through a size and TTL bounded LRU cache.
+
+    Entries are keyed by rating key and dropped when the library reports a change to
+    that item, wire invalidate_change to LibraryStats.on_change. Concurrent lookups of
+    the same key share one fetch.
+    """
+
+    def __init__(self, gateway, max_size=512, ttl=600):
+        self.gateway = gateway
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()  # rating key -> (expires at, item)
+        self._fetching = {}
+
+    async def get(self, rating_key):
+        cached = self._items.get(rating_key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._items.move_to_end(rating_key)
+            lookups.inc(result="hit")
+            return cached[1]
+        lookups.inc(result="miss")
+        fetch = self._fetching.get(rating_key)
+        if fetch is None:
+            fetch = asyncio.create_task(self._fetch(rating_key))
+            self._fetching[rating_key] = fetch
+            fetch.add_done_callback(lambda done: self._fetched(rating_key, done))
+        # shield so one caller giving up doesn't cancel the fetch for the others
+        return await asyncio.shield(fetch)
+
+    async def _fetch(self, rating_key):
+        try:
+            item = await self.gateway.fetch_item(rating_key)
+        except NotFound:
+            raise MediaNotFound("Could not find that media on Plex.")
+        # Invalidated while fetching, the item may already be out of date
+        if self._fetching.get(rating_key) is not asyncio.current_task():
+            return item
+        self._items[rating_key] = (time.monotonic() + self.ttl, item)
+        self._items.move_to_end(rating_key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return item
+
+    def _fetched(self, rating_key, fetch):
+        if self._fetching.get(rating_key) is fetch:
+            del self._fetching[rating_key]
+
+    def invalidate(self, rating_key):
+        self._items.pop(rating_key, None)
+        self._fetching.pop(rating_key, None)
+
+    def invalidate_change(self, action, item_id, section_id, plex_type):
+        self.invalidate(item_id)
+
+    def clear(self):
+        self._items.clear()
+        self._fetching.clear()
@@ -0,0 +1,237 @@
+"""Prometheus text-format metrics, kept in process and served by the bot's web server.
+
+Operations are timed with `track(kind, name)` or the `timed(kind, name)` decorator,
+which feed one latency histogram and one error counter labelled by kind (command,
+button, plex, stripe, mongo, job, ...) and name.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+
+from aiohttp import web
+from pymongo import monitoring
+
+# Seconds, from a fast Mongo lookup up to a full checker run
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()  # Mongo command events arrive on pymongo threads
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    render = Counter.render
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            # [per-bucket counts, sum, count], count includes values above every bucket
+            entry = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(
+                    f"{self.name}_bucket{_labels({**labels, 'le': bound})} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {count}"
+            )
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+duration = Histogram(
+    "plexbot_operation_duration_seconds",
+    "Time taken by commands, button callbacks, upstream calls and jobs.",
+)
+errors = Counter(
+    "plexbot_operation_errors_total",
+    "Commands, button callbacks, upstream calls and jobs that raised.",
+)
+_metrics = [duration, errors]
+_collectors = []
+
+# Labels of the tracked operations the current task is inside, outermost first, e.g.
+# ("button:add_time", "interaction:payment", "plex:inviteFriend"). Tasks inherit it
+operation = contextvars.ContextVar("operation", default=())
+# The same per task, readable from other threads to attribute event loop stalls
+running = {}
+
+
+def counter(name, help):
+    metric = Counter(name, help)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name, help):
+    metric = Gauge(name, help)
+    _metrics.append(metric)
+    return metric
+
+
+def collector(func):
+    """Register a coroutine function that refreshes gauges before each scrape."""
+    _collectors.append(func)
+    return func
+
+
+def count_error(kind, name):
+    errors.inc(kind=kind, name=name)
+
+
+def observe(kind, name, seconds, failed=False):
+    duration.observe(seconds, kind=kind, name=name)
+    if failed:
+        count_error(kind, name)
+
+
+class track:
+    """Time a block: `with track("plex", "invite"):`, also inside coroutines."""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.token = operation.set(operation.get() + (f"{self.kind}:{self.name}",))
+        try:
+            self.task = asyncio.current_task()
+        except RuntimeError:
+            self.task = None  # not on the event loop
+        if self.task is not None:
+            # Child tasks inherit the parent's operations, so restore what the task
+            # itself had rather than going by the context
+            self.previous = running.get(self.task)
+            running[self.task] = operation.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        operation.reset(self.token)
+        if self.task is not None:
+            if self.previous is not None:
+                running[self.task] = self.previous
+            else:
+                running.pop(self.task, None)
+        observe(
+            self.kind,
+            self.name,
+            time.perf_counter() - self.started,
+            failed=exc_type is not None,
+        )
+        return False
+
+
+def timed(kind, name=None):
+    """Decorator form of track() for coroutine functions, name defaults to the function's."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track(kind, name or func.__name__):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every Mongo command, pass it to the client as event_listeners=[...]."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe("mongo", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe("mongo", event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        with _lock:
+            lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request):
+    for func in _collectors:
+        try:
+            await func()
+        except Exception as e:
+            print(f"Metrics collector {func.__name__} failed: {e}")
+    return web.Response(
+        body=render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
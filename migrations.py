@@ -0,0 +1,166 @@
+import datetime
+
+import pymongo
+
+from outbox import SENT, warning_key
+
+# Indexes backing the hot lookups in bot.py, keyed by collection name
+INDEXES = {
+    "plex": [
+        ([("email", pymongo.ASCENDING)], {"name": "email_unique", "unique": True}),
+        (
+            [("discord_id", pymongo.ASCENDING)],
+            {"name": "discord_id_unique", "unique": True},
+        ),
+        ([("expiration_date", pymongo.ASCENDING)], {"name": "expiration_date"}),
+        ([("server", pymongo.ASCENDING)], {"name": "server"}),
+    ],
+    "payments": [
+        (
+            [
+                ("discord_id", pymongo.ASCENDING),
+                ("active", pymongo.ASCENDING),
+                ("paid", pymongo.ASCENDING),
+            ],
+            {"name": "discord_id_active_paid"},
+        ),
+        ([("invoice_id", pymongo.ASCENDING)], {"name": "invoice_id"}),
+        (
+            [("paid", pymongo.ASCENDING), ("active", pymongo.ASCENDING)],
+            {"name": "paid_active"},
+        ),
+    ],
+    "capacity_reservations": [
+        (
+            [("server", pymongo.ASCENDING), ("expires_at", pymongo.ASCENDING)],
+            {"name": "server_expires_at"},
+        ),
+    ],
+    "outbox": [
+        (
+            [("state", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)],
+            {"name": "state_next_attempt_at"},
+        ),
+        # Delivered messages only need to be kept while they can still be repeated
+        (
+            [("sent_at", pymongo.ASCENDING)],
+            {"name": "sent_at_ttl", "expireAfterSeconds": 90 * 86400},
+        ),
+    ],
+}
+
+
+async def backfill_plex_defaults(collections):
+    # Older documents were written before sent_notifications/expired existed
+    plex = collections["plex"]
+    await plex.update_many(
+        {"sent_notifications": {"$exists": False}}, {"$set": {"sent_notifications": []}}
+    )
+    await plex.update_many(
+        {"expired": {"$exists": False}}, {"$set": {"expired": False}}
+    )
+
+
+async def move_sent_notifications_to_outbox(collections):
+    # Record warnings that were already sent as delivered outbox messages so the
+    # outbox does not send them again, then drop the old list
+    plex = collections["plex"]
+    outbox = collections["outbox"]
+    now = datetime.datetime.utcnow()
+    users = plex.find(
+        {"sent_notifications.0": {"$exists": True}, "expiration_date": {"$ne": None}},
+        {"discord_id": 1, "expiration_date": 1, "sent_notifications": 1},
+    )
+    async for user in users:
+        for days in user["sent_notifications"]:
+            await outbox.update_one(
+                {"_id": warning_key(user["discord_id"], user["expiration_date"], days)},
+                {
+                    "$setOnInsert": {
+                        "discord_id": user["discord_id"],
+                        "content": None,
+                        "state": SENT,
+                        "attempts": 1,
+                        "created_at": now,
+                        "sent_at": now,
+                    }
+                },
+                upsert=True,
+            )
+    await plex.update_many(
+        {"sent_notifications": {"$exists": True}},
+        {"$unset": {"sent_notifications": ""}},
+    )
+
+
+# (version, description, coroutine function), append new migrations to the end
+MIGRATIONS = [
+    (
+        1,
+        "Backfill sent_notifications and expired on plex documents",
+        backfill_plex_defaults,
+    ),
+    (
+        2,
+        "Move sent_notifications into the outbox",
+        move_sent_notifications_to_outbox,
+    ),
+]
+
+
+async def run_migrations(collections, state):
+    """Apply every migration newer than the version recorded in the state collection."""
+    record = await state.find_one({"_id": "schema"})
+    current = record["version"] if record else 0
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Running migration {version}: {description}")
+        await migration(collections)
+        await state.update_one(
+            {"_id": "schema"},
+            {"$set": {"version": version, "updated_at": datetime.datetime.utcnow()}},
+            upsert=True,
+        )
+        current = version
+    return current
+
+
+async def find_duplicates(collection, field):
+    pipeline = [
+        {"$match": {field: {"$ne": None}}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    return [doc["_id"] async for doc in collection.aggregate(pipeline)]
+
+
+async def ensure_indexes(collections):
+    """Create the indexes in INDEXES and return a list of problems found.
+
+    Unique indexes are skipped (and reported) when existing documents would violate them.
+    """
+    problems = []
+    skipped = set()
+    for name, indexes in INDEXES.items():
+        collection = collections[name]
+        for keys, options in indexes:
+            if options.get("unique"):
+                duplicates = await find_duplicates(collection, keys[0][0])
+                if duplicates:
+                    problems.append(
+                        f"{name}.{options['name']} not created, duplicate values: {duplicates[:10]}"
+                    )
+                    skipped.add(options["name"])
+                    continue
+            try:
+                await collection.create_index(keys, **options)
+            except pymongo.errors.PyMongoError as e:
+                problems.append(f"{name}.{options['name']} could not be created: {e}")
+                skipped.add(options["name"])
+
+        existing = await collection.index_information()
+        for keys, options in indexes:
+            if options["name"] not in existing and options["name"] not in skipped:
+                problems.append(f"{name}.{options['name']} is missing")
+    return problems
@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+
+import discord
+import pymongo
+
+# Documents move pending -> sending -> sent, or back to pending with a later
+# next_attempt_at on a retryable error, or to failed once retries run out
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+# How often idle workers look for retries that became due
+POLL_SECONDS = 30
+# A message left in "sending" this long was interrupted by a restart
+SENDING_TIMEOUT = datetime.timedelta(minutes=5)
+
+
+def warning_key(discord_id, expiration_date, days):
+    # Includes the expiration date so a renewed subscription is warned again
+    return f"warn:{discord_id}:{expiration_date.isoformat(timespec='seconds')}:{days}"
+
+
+def expired_key(discord_id, expiration_date):
+    return f"expired:{discord_id}:{expiration_date.isoformat(timespec='seconds')}"
+
+
+def cancelled_key(invoice_id):
+    return f"cancelled:{invoice_id}"
+
+
+def retry_after(error):
+    """Seconds Discord asked us to wait, from a 429 response, or None."""
+    if not isinstance(error, discord.HTTPException) or error.status != 429:
+        return None
+    headers = getattr(error.response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", 1))
+    except ValueError:
+        return 1.0
+
+
+class Outbox:
+    """Mongo-backed queue of direct messages, drained by a small pool of workers.
+
+    The document _id is a dedupe key, so enqueueing the same notification twice is a
+    no-op and delivery state survives restarts. A message is only sent again if the bot
+    stops between sending it and recording it as sent.
+    """
+
+    def __init__(
+        self, collection, send, on_failed=None, workers=3, max_attempts=5, backoff=10
+    ):
+        self.collection = collection
+        self.send = send
+        self.on_failed = on_failed
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._wakeup = asyncio.Event()
+        # Shared by all workers when Discord rate limits us
+        self._paused_until = 0
+        self._tasks = []
+
+    async def enqueue(self, key, discord_id, content):
+        """Queue a message, returns False if one with the same key was already queued."""
+        now = datetime.datetime.utcnow()
+        try:
+            await self.collection.insert_one(
+                {
+                    "_id": key,
+                    "discord_id": discord_id,
+                    "content": content,
+                    "state": PENDING,
+                    "attempts": 0,
+                    "created_at": now,
+                    "next_attempt_at": now,
+                }
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        self._wakeup.set()
+        return True
+
+    async def start(self):
+        if self._tasks:
+            return
+        # Recover messages claimed by a worker that never finished
+        await self.collection.update_many(
+            {
+                "state": SENDING,
+                "claimed_at": {"$lt": datetime.datetime.utcnow() - SENDING_TIMEOUT},
+            },
+            {"$set": {"state": PENDING}},
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _claim(self):
+        now = datetime.datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"state": PENDING, "next_attempt_at": {"$lte": now}},
+            {"$set": {"state": SENDING, "claimed_at": now}},
+            sort=[("next_attempt_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                pause = self._paused_until - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                message = await self._claim()
+                if message is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._deliver(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+                await asyncio.sleep(POLL_SECONDS)
+
+    async def _deliver(self, message):
+        try:
+            await self.send(message["discord_id"], message["content"])
+        except Exception as e:
+            await self._failed_attempt(message, e)
+            return
+        await self.collection.update_one(
+            {"_id": message["_id"]},
+            {
+                "$set": {"state": SENT, "sent_at": datetime.datetime.utcnow()},
+                "$inc": {"attempts": 1},
+            },
+        )
+
+    async def _failed_attempt(self, message, error):
+        attempts = message["attempts"] + 1
+        wait = retry_after(error)
+        if wait is not None:
+            loop = asyncio.get_running_loop()
+            self._paused_until = max(self._paused_until, loop.time() + wait)
+            attempts -= 1  # being rate limited is not the message's fault
+        else:
+            wait = self.backoff * 2 ** (attempts - 1)
+        # Closed DMs or an unknown user won't fix themselves
+        permanent = isinstance(error, (discord.Forbidden, discord.NotFound))
+        if permanent or attempts >= self.max_attempts:
+            await self.collection.update_one(
+                {"_id": message["_id"]},
+                {
+                    "$set": {
+                        "state": FAILED,
+                        "attempts": attempts,
+                        "error": str(error),
+                    }
+                },
+            )
+            if self.on_failed is not None:
+                self.on_failed(message, error)
+            return
+        await self.collection.update_one(
+            {"_id": message["_id"]},
+            {
+                "$set": {
+                    "state": PENDING,
+                    "attempts": attempts,
+                    "error": str(error),
+                    "next_attempt_at": datetime.datetime.utcnow()
+                    + datetime.timedelta(seconds=wait),
+                }
+            },
+        )
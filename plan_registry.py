@@ -0,0 +1,117 @@
+import os
+
+import discord
+import yaml
+
+from stripe_checkout import CHECKOUT_MODES
+
+REQUIRED_KEYS = [
+    "name",
+    "stripe_price_id",
+    "price",
+    "concurrent_streams",
+    "downloads_enabled",
+    "4k_enabled",
+    "role_id",
+]
+
+DOWNLOADS_NOTE = "*Plex accounts created after August 1, 2022 require a Plex Pass to utilize downloads. For more information, see https://support.plex.tv/articles/downloads-sync-faq/."
+
+
+def plan_description(plan):
+    return (
+        f"Price: ${plan['price']}\n"
+        f"Concurrent Streams: {plan['concurrent_streams']}\n"
+        f"Downloads Enabled: {'Yes*' if plan['downloads_enabled'] else 'No'}\n"
+        f"4K Enabled: {'Yes' if plan['4k_enabled'] else 'No'}\n"
+    )
+
+
+class PlanRegistry:
+    """Plans from plans.yml, indexed for lookups, with their embeds built once.
+
+    A registry is never modified after it is built; reloading builds a new one and swaps it in.
+    """
+
+    def __init__(self, plans, mtime=None):
+        self.plans = plans
+        self.mtime = mtime
+        self.by_name = {plan["name"]: plan for plan in plans}
+        self.by_price_id = {plan["stripe_price_id"]: plan for plan in plans}
+        self.by_role_id = {str(plan["role_id"]): plan for plan in plans}
+        self.by_key = {self.key(plan): plan for plan in plans}
+        self.role_ids = [plan["role_id"] for plan in plans]
+        self.chosen_embeds = {plan["name"]: self._chosen_embed(plan) for plan in plans}
+        self.summary_embed = self._summary_embed()
+        self.menu_embed = self._menu_embed()
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    @staticmethod
+    def key(plan):
+        # Used in component custom IDs, "basic"/"standard"/"extra" match the original buttons
+        return plan["name"].lower()
+
+    @staticmethod
+    def _chosen_embed(plan):
+        embed = discord.Embed(title="Chosen Plan", color=discord.Color.blue())
+        embed.add_field(name=plan["name"], value=plan_description(plan), inline=False)
+        if plan["downloads_enabled"]:
+            embed.add_field(name="", value=DOWNLOADS_NOTE, inline=False)
+        return embed
+
+    def _summary_embed(self):
+        embed = discord.Embed()
+        for plan in self.plans:
+            embed.add_field(
+                name=plan["name"], value=plan_description(plan), inline=True
+            )
+        embed.add_field(name="", value=DOWNLOADS_NOTE, inline=False)
+        return embed
+
+    def _menu_embed(self):
+        embed = discord.Embed(
+            title="Plex Plans",
+            description="Choose the plan that best suits your needs:",
+            color=discord.Color.blue(),
+        )
+        for plan in self.plans:
+            embed.add_field(
+                name=plan["name"], value=plan_description(plan), inline=True
+            )
+        embed.add_field(
+            name="One Time Payment Plan",
+            value="Your card details are not saved, you will need to manually add more time to avoid being removed.",
+            inline=False,
+        )
+        embed.add_field(name="", value=DOWNLOADS_NOTE, inline=False)
+        return embed
+
+
+def validate_plans(plans):
+    if not plans:
+        raise ValueError("plans.yml has no plans")
+    if len(plans) > 100:
+        raise ValueError("at most 100 plans fit in the plan menu")
+    names = set()
+    for plan in plans:
+        missing = [key for key in REQUIRED_KEYS if key not in plan]
+        if missing:
+            raise ValueError(f"plan {plan.get('name')} is missing {', '.join(missing)}")
+        if plan.get("checkout", "invoice") not in CHECKOUT_MODES:
+            raise ValueError(
+                f"plan {plan['name']} has an unknown checkout mode {plan['checkout']}"
+            )
+        if plan["name"].lower() in names:
+            raise ValueError(f"plan {plan['name']} is defined twice")
+        names.add(plan["name"].lower())
+
+
+def load_plan_registry(path):
+    mtime = os.stat(path).st_mtime
+    with open(path, "r") as file:
+        plans_data = yaml.safe_load(file)
+    plans = plans_data["plans"]
+    validate_plans(plans)
+    return PlanRegistry(plans, mtime=mtime)
@@ -0,0 +1,57 @@
+import json
+import os
+
+from plexapi.myplex import MyPlexAccount
+from plexapi.server import PlexServer
+
+# Fail fast on a stale cached address instead of waiting for the default timeout
+CONNECT_TIMEOUT = 10
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, server, sections):
+    data = {
+        "url": server._baseurl,
+        "token": server._token,
+        "machine_identifier": server.machineIdentifier,
+        "sections": [
+            {"key": section.key, "title": section.title, "type": section.type}
+            for section in sections
+        ],
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def connect_server(
+    cache, url=None, token=None, username=None, password=None, server_name=None
+):
+    """Connect to the server, trying the cached address, then PLEX_SERVER_URL/PLEX_TOKEN,
+    then plex.tv discovery with the account login. Blocking, run it off the event loop.
+    """
+    candidates = []
+    if cache.get("url") and cache.get("token"):
+        candidates.append((cache["url"], cache["token"]))
+    if url and token and (url, token) not in candidates:
+        candidates.append((url, token))
+    for candidate_url, candidate_token in candidates:
+        try:
+            return PlexServer(candidate_url, candidate_token, timeout=CONNECT_TIMEOUT)
+        except Exception as e:
+            print(f"Could not connect to Plex at {candidate_url}: {e}")
+
+    # Slow path: log in and try every connection plex.tv advertises for the server
+    if token and not (username and password):
+        account = MyPlexAccount(token=token)
+    else:
+        account = MyPlexAccount(username, password)
+    return account.resource(server_name).connect()
@@ -0,0 +1,209 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+
+from metrics import track
+
+# Seconds each kind of plex call is allowed to take before the caller gets an error
+DEFAULT_TIMEOUTS = {
+    "invite": 30,
+    "remove": 30,
+    "fetch": 15,
+    "upload": 60,
+    "stats": 120,
+    "roster": 60,
+    "connect": 120,
+    "index": 60,
+}
+
+# How many calls of each kind may be in flight at once
+DEFAULT_LIMITS = {
+    "invite": 4,
+    "remove": 4,
+    "fetch": 8,
+    "upload": 2,
+    "stats": 2,
+    "roster": 1,
+    "connect": 1,
+    "index": 1,
+}
+
+
+# Operations that go to plex.tv rather than the media server, these share the rate limit
+PLEX_TV_OPERATIONS = {"invite", "remove", "roster"}
+
+
+class PlexGatewayError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Spaces calls out so no more than `rate` start in any `per` seconds."""
+
+    def __init__(self, rate, per=60):
+        self.interval = per / rate
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class PlexGateway:
+    """Runs the blocking plexapi calls on a bounded thread pool so they never block the event loop."""
+
+    def __init__(
+        self,
+        server,
+        account=None,
+        max_workers=8,
+        timeouts=None,
+        limits=None,
+        rate_limiter=None,
+    ):
+        self.server = server
+        self.account = account
+        self.rate_limiter = rate_limiter
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="plex"
+        )
+        self._semaphores = {}
+        self.ready = asyncio.Event()
+        if server is not None:
+            self.ready.set()
+
+    def set_server(self, server, account=None):
+        """Attach the server once a background connection finishes, releasing waiting calls."""
+        self.server = server
+        self.account = account
+        self.ready.set()
+
+    def _semaphore(self, operation):
+        if operation not in self._semaphores:
+            self._semaphores[operation] = asyncio.Semaphore(
+                self.limits.get(operation, 4)
+            )
+        return self._semaphores[operation]
+
+    def _account(self):
+        # myPlexAccount() can hit plex.tv on older plexapi versions, only do it once
+        if self.account is None:
+            self.account = self.server.myPlexAccount()
+        return self.account
+
+    async def run(self, operation, func, *args, **kwargs):
+        timeout = self.timeouts.get(operation, 30)
+        if operation != "connect" and not self.ready.is_set():
+            try:
+                await asyncio.wait_for(
+                    self.ready.wait(), timeout=self.timeouts["connect"]
+                )
+            except asyncio.TimeoutError:
+                raise PlexGatewayError("Plex is not connected yet, try again shortly")
+        async with self._semaphore(operation):
+            if self.rate_limiter is not None and operation in PLEX_TV_OPERATIONS:
+                await self.rate_limiter.acquire()
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+            try:
+                with track("plex", operation):
+                    return await asyncio.wait_for(future, timeout=timeout)
+            except asyncio.TimeoutError:
+                # The worker thread keeps running, but the caller is released
+                raise PlexGatewayError(f"Plex {operation} timed out after {timeout}s")
+
+    async def invite_friend(self, email, sections, allow_sync=False):
+        return await self.run(
+            "invite",
+            lambda: self._account().inviteFriend(
+                email, self.server, allowSync=allow_sync, sections=sections
+            ),
+        )
+
+    async def remove_friend(self, user):
+        return await self.run("remove", lambda: self._account().removeFriend(user))
+
+    async def cancel_invite(self, user):
+        return await self.run("remove", lambda: self._account().cancelInvite(user))
+
+    async def remove_share(self, user):
+        """Stop sharing this server with a friend or invitee, other servers stay shared.
+
+        removeFriend ends the whole friendship, with every server of the account.
+        """
+
+        def remove():
+            account = self._account()
+            machine_id = self.server.machineIdentifier
+            for shared in user.servers:
+                if shared.machineIdentifier == machine_id:
+                    account.query(
+                        account.FRIENDSERVERS.format(
+                            machineId=machine_id, serverId=shared.id
+                        ),
+                        account._session.delete,
+                    )
+
+        return await self.run("remove", remove)
+
+    async def fetch_shares(self):
+        """Return (friends, sent pending invites) for the account in two plex.tv calls."""
+
+        def fetch():
+            account = self._account()
+            return account.users(), account.pendingInvites(includeReceived=False)
+
+        return await self.run("roster", fetch)
+
+    async def fetch_item(self, rating_key):
+        return await self.run("fetch", lambda: self.server.fetchItem(int(rating_key)))
+
+    async def episodes(self, item):
+        return await self.run("fetch", item.episodes)
+
+    async def upload_subtitles(self, media, filename, data):
+        """Media.uploadSubtitles from an open file instead of a path on disk."""
+
+        def upload():
+            data.seek(0)
+            server = media._server
+            server.query(
+                f"{media.key}/subtitles",
+                server._session.post,
+                data=data,
+                params={"title": filename, "format": os.path.splitext(filename)[1][1:]},
+                headers={"Accept": "text/plain, */*"},
+            )
+
+        return await self.run("upload", upload)
+
+    async def section_page(self, section, start, size, convert):
+        """A page of a section's items, each passed through convert on the worker thread."""
+        return await self.run(
+            "index",
+            lambda: [
+                convert(item)
+                for item in section.search(
+                    container_start=start, container_size=size, maxresults=size
+                )
+            ],
+        )
+
+    async def section_size(self, section, libtype=None):
+        if libtype is None:
+            return await self.run("stats", lambda: section.totalSize)
+        return await self.run("stats", section.totalViewSize, libtype=libtype)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+
+
+class PlexRoster:
+    """Cached view of who the server is shared with, built from one bulk plex.tv fetch."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        # lowercased email -> MyPlexUser / MyPlexInvite (None when we invited them since the last refresh)
+        self.friends = {}
+        self.invites = {}
+        self.refreshed_at = None
+        self._refreshing = None
+
+    async def refresh(self):
+        # Concurrent callers (e.g. a burst of removals) share one bulk fetch
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._refresh())
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh(self):
+        users, invites = await self.gateway.fetch_shares()
+        machine_id = self.gateway.server.machineIdentifier
+        self.friends = {
+            user.email.lower(): user
+            for user in users
+            if user.email and self._shares_server(user, machine_id)
+        }
+        self.invites = {
+            invite.email.lower(): invite
+            for invite in invites
+            if invite.email and self._shares_server(invite, machine_id)
+        }
+        self.refreshed_at = datetime.datetime.utcnow()
+
+    @staticmethod
+    def _shares_server(user, machine_id):
+        return any(server.machineIdentifier == machine_id for server in user.servers)
+
+    def emails(self):
+        return set(self.friends) | set(self.invites)
+
+    def status(self, email):
+        email = email.lower()
+        if email in self.friends:
+            return "shared"
+        if email in self.invites:
+            return "invited"
+        return None
+
+    def mark_invited(self, email):
+        self.invites.setdefault(email.lower(), None)
+
+    async def remove(self, email, retry=True):
+        """Remove a share or cancel a pending invite, whichever the user has.
+
+        Returns False if the roster has no share for this email.
+        """
+        if self.refreshed_at is None:
+            await self.refresh()
+        key = email.lower()
+        try:
+            if key in self.friends:
+                await self.gateway.remove_friend(self.friends[key] or email)
+                self.friends.pop(key, None)
+                return True
+            if key in self.invites:
+                await self.gateway.cancel_invite(self.invites[key] or email)
+                self.invites.pop(key, None)
+                return True
+        except Exception:
+            # The cache was stale (e.g. an invite was accepted), refresh and try once more
+            if not retry:
+                raise
+            await self.refresh()
+            return await self.remove(email, retry=False)
+        return False
+
+    async def remove_share(self, email):
+        """Stop sharing this server with email, keeping their shares of other servers.
+
+        Returns False if the roster has no share for this email.
+        """
+        key = email.lower()
+        # None entries are invites sent since the last refresh
+        entry = self.friends.get(key) or self.invites.get(key)
+        if entry is None:
+            await self.refresh()
+            entry = self.friends.get(key) or self.invites.get(key)
+            if entry is None:
+                return False
+        await self.gateway.remove_share(entry)
+        self.friends.pop(key, None)
+        self.invites.pop(key, None)
+        return True
+
+    def diff(self, expected_emails):
+        """Return (missing, unknown): subscribers without a share, and shares without a subscriber."""
+        expected = {email.lower() for email in expected_emails}
+        on_server = self.emails()
+        return expected - on_server, on_server - expected
@@ -1,32 +1,31 @@
+import argparse
+import asyncio
 import datetime
-import math
 import os
 import sys
 
-import discord
 import dotenv
-import pymongo
+import motor.motor_asyncio
 import yaml
-from async_stripe import stripe
-from discord.ext import tasks
-from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
+
+from plex_connection import connect_server, load_cache
+from plex_gateway import PlexGateway, RateLimiter
+from server_pool import load_server_configs
 
 # Load Environment Variables
 dotenv.load_dotenv()
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 PLEX_SERVER_URL = os.getenv("PLEX_SERVER_URL")
-PLEX_TOKEN = os.getenv("PLEX_SERVER_TOKEN")
-GUILD_ID = os.getenv("GUILD_ID")
+PLEX_TOKEN = os.getenv("PLEX_TOKEN") or os.getenv("PLEX_SERVER_TOKEN")
 MONGODB_URL = os.getenv("MONGODB_URL")
 PLEX_USERNAME = os.getenv("PLEX_USERNAME")
 PLEX_PASSWORD = os.getenv("PLEX_PASSWORD")
 PLEX_SERVER_NAME = os.getenv("PLEX_SERVER_NAME")
-DISCORD_ADMIN_ROLE_ID = os.getenv("DISCORD_ADMIN_ROLE_ID")
-STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
-DISCORD_ADMIN_ID = os.getenv("DISCORD_ADMIN_ID")
-STATS = os.getenv("STATS")
-STATS_CHANNEL_ID = os.getenv("STATS_CHANNEL_ID")
+PLEX_CACHE_FILE = os.getenv("PLEX_CACHE_FILE") or ".plex_cache.json"
+PLEX_SERVER_CAPACITY = int(os.getenv("PLEX_SERVER_CAPACITY") or 100)
+SERVERS_FILE = os.getenv("SERVERS_FILE") or "servers.yml"
+
+# Statuses that count as done when resuming a run
+DONE_STATUSES = ["invited", "skipped"]
 
 
 def load_plans():
@@ -37,89 +36,197 @@ def load_plans():
 
 plans = load_plans()
 
-role_ids = []
-
-for plan in plans:
-    role_ids.append(plan["role_id"])
-
-# Setup Stripe
-stripe.api_key = STRIPE_API_KEY
-
-
-# Setup Plex Server
-try:
-    print("Connecting to Plex... This may take a few seconds.")
-    account = MyPlexAccount(PLEX_USERNAME, PLEX_PASSWORD)
-    plex = account.resource(PLEX_SERVER_NAME).connect()  # returns a PlexServer instance
-    print("Connected to Plex Server")
-
-except Exception as e:
-    print(e)
-    sys.exit()
-
-
-# setup sections
-
-sections_standard = []
-sections_4k = []
-sections_all = []
-
-sections_movies = []
-sections_tv = []
-
-for section in plex.library.sections():
-    if "4K" not in section.title:
-        sections_standard.append(section)
-    sections_all.append(section)
-
-    if section.type == "movie":
-        sections_movies.append(section)
-    elif section.type == "show":
-        sections_tv.append(section)
-
-
-# Setup MongoDB with motor
-client = pymongo.MongoClient(MONGODB_URL)
-db_plex = client["pycord"]
-db_payments = client["pycord"]
-db_subscriptions = client["pycord"]
-cursor = db_plex["plex"].find()
 
-
-def add_to_plex(email, discord_id, plan_name):
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Reinvite every subscriber in the database to their Plex server."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report what would be done, no invites or checkpoint writes",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="invites in flight at once"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=30, help="maximum plex.tv calls per minute"
+    )
+    parser.add_argument(
+        "--run-id",
+        default=PLEX_SERVER_NAME,
+        help="checkpoint name, reuse it to resume an interrupted run",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="forget the checkpoint for this run id and start over",
+    )
+    return parser.parse_args()
+
+
+def connect_plex(config, rate):
     try:
-        # find "downloads_enabled" and "4k_enabled" in the plans value and set them to the vars here
+        print(
+            f"Connecting to Plex server {config['name']}... This may take a few seconds."
+        )
+        plex = connect_server(
+            load_cache(config["cache_file"]),
+            url=config["url"],
+            token=config["token"],
+            username=PLEX_USERNAME,
+            password=PLEX_PASSWORD,
+            server_name=config["name"],
+        )
+        print(f"Connected to Plex server {config['name']}")
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    sections_standard = []
+    sections_all = []
+    for section in plex.library.sections():
+        if "4K" not in section.title:
+            sections_standard.append(section)
+        sections_all.append(section)
+
+    gateway = PlexGateway(plex, rate_limiter=RateLimiter(rate))
+    return gateway, sections_standard, sections_all
+
+
+async def already_shared(gateway):
+    # One bulk fetch instead of asking plex.tv about every user
+    users, invites = await gateway.fetch_shares()
+    machine_id = gateway.server.machineIdentifier
+    emails = set()
+    for user in users + invites:
+        if user.email and any(
+            server.machineIdentifier == machine_id for server in user.servers
+        ):
+            emails.add(user.email.lower())
+    return emails
+
+
+async def main():
+    args = parse_args()
+    configs = load_server_configs(
+        SERVERS_FILE,
+        {
+            "name": PLEX_SERVER_NAME or "default",
+            "url": PLEX_SERVER_URL,
+            "token": PLEX_TOKEN,
+            "capacity": PLEX_SERVER_CAPACITY,
+            "cache_file": PLEX_CACHE_FILE,
+        },
+    )
+    # name -> (gateway, sections_standard, sections_all), subscribers without a
+    # server are on the first one
+    servers = {config["name"]: connect_plex(config, args.rate) for config in configs}
+    primary = configs[0]["name"]
+
+    client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
+    db_plex = client["pycord"]
+    progress = db_plex["reinvite_progress"]
+
+    if args.restart and not args.dry_run:
+        await progress.delete_many({"run_id": args.run_id})
+    done = {
+        doc["email"]
+        async for doc in progress.find(
+            {"run_id": args.run_id, "status": {"$in": DONE_STATUSES}}, {"email": 1}
+        )
+    }
+    shared = {}
+    for name, (gateway, _, _) in servers.items():
+        shared[name] = await already_shared(gateway)
+    print(
+        f"Run {args.run_id}: {len(done)} users already done, {sum(len(emails) for emails in shared.values())} emails already shared or invited"
+    )
+
+    counts = {"invited": 0, "skipped": 0, "failed": 0, "resumed": 0}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def record(email, status, error=None):
+        counts[status] += 1
+        if args.dry_run:
+            return
+        await progress.update_one(
+            {"_id": f"{args.run_id}:{email}"},
+            {
+                "$set": {
+                    "run_id": args.run_id,
+                    "email": email,
+                    "status": status,
+                    "error": error,
+                    "updated_at": datetime.datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+
+    async def reinvite(user):
+        email = user["email"]
+        plan_name = user["plan_name"]
+        if email in done:
+            counts["resumed"] += 1
+            return
+        server = user.get("server") or primary
+        if server not in servers:
+            print(f"Unknown server {server} for {email}")
+            await record(email, "failed", f"unknown server {server}")
+            return
+        gateway, sections_standard, sections_all = servers[server]
+        if email.lower() in shared[server]:
+            await record(email, "skipped")
+            return
         selected_plan = next(
             (plan for plan in plans if plan["name"] == plan_name), None
         )
-        downloads_enabled = selected_plan["downloads_enabled"]
-        enabled_4k = selected_plan["4k_enabled"]
-        if enabled_4k:
+        if selected_plan is None:
+            print(f"Unknown plan {plan_name} for {email}")
+            await record(email, "failed", f"unknown plan {plan_name}")
+            return
+        if selected_plan["4k_enabled"]:
             add_sections = sections_all
         else:
             add_sections = sections_standard
-        plex.myPlexAccount().inviteFriend(
-            email,
-            plex,
-            allowSync=downloads_enabled,
-            sections=add_sections,
-        )
-        # If successful, add the email, discord id and share status to the database
-        return True
-    except Exception as e:
-        return e
-succ = 0
-fail = 0
-for user in cursor:
-    discord_id = user["discord_id"]
-    email = user["email"]
-    plan_name = user["plan_name"]
-    try:
-        print(add_to_plex(email, discord_id, plan_name), "for", email, "with plan", plan_name, "and discord id", discord_id)
-        succ += 1
-    except Exception as e:
-        print(e)
-        fail += 1
-
-print("Successes:", succ)
-print("Failures:", fail)
\ No newline at end of file
+        if args.dry_run:
+            print(f"Would invite {email} to {server} with plan {plan_name}")
+            counts["invited"] += 1
+            return
+        async with semaphore:
+            try:
+                await gateway.invite_friend(
+                    email,
+                    add_sections,
+                    allow_sync=selected_plan["downloads_enabled"],
+                )
+            except Exception as e:
+                print(f"Failed to invite {email}: {e}")
+                await record(email, "failed", str(e))
+                return
+        print(f"Invited {email} to {server} with plan {plan_name}")
+        await record(email, "invited")
+
+    batch = []
+    async for user in db_plex["plex"].find(
+        {},
+        {"email": 1, "plan_name": 1, "discord_id": 1, "server": 1},
+        batch_size=100,
+    ):
+        batch.append(reinvite(user))
+        if len(batch) >= 100:
+            await asyncio.gather(*batch)
+            batch = []
+    await asyncio.gather(*batch)
+
+    for gateway, _, _ in servers.values():
+        gateway.shutdown()
+    print("Invited:", counts["invited"])
+    print("Skipped (already shared):", counts["skipped"])
+    print("Skipped (done in an earlier run):", counts["resumed"])
+    print("Failures:", counts["failed"])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""Post a signed Stripe fixture event to the bot's webhook, for testing without Stripe.
+
+Usage: python send_stripe_event.py invoice.paid --invoice in_123
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import aiohttp
+import dotenv
+
+dotenv.load_dotenv()
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "stripe"
+)
+
+
+def sign(payload, secret, timestamp=None):
+    # Same scheme Stripe uses: HMAC-SHA256 over "<timestamp>.<payload>"
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(
+        secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def load_fixture(event_type, invoice_id=None):
+    with open(os.path.join(FIXTURES_DIR, f"{event_type}.json"), "r") as file:
+        event = json.load(file)
+    if invoice_id:
+        event["data"]["object"]["id"] = invoice_id
+    event["id"] = f"evt_fixture_{int(time.time() * 1000)}"
+    event["created"] = int(time.time())
+    return event
+
+
+async def send(url, event, secret):
+    payload = json.dumps(event)
+    headers = {
+        "Content-Type": "application/json",
+        "Stripe-Signature": sign(payload, secret),
+    }
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=payload, headers=headers) as response:
+            return response.status, await response.text()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("event_type", help="fixture name, e.g. invoice.paid")
+    parser.add_argument(
+        "--invoice", help="invoice or checkout session id to put in the event"
+    )
+    parser.add_argument(
+        "--url",
+        default=f"http://127.0.0.1:{os.getenv('WEB_PORT') or 8080}/stripe/webhook",
+    )
+    parser.add_argument("--secret", default=os.getenv("STRIPE_WEBHOOK_SECRET"))
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("set STRIPE_WEBHOOK_SECRET or pass --secret")
+
+    event = load_fixture(args.event_type, args.invoice)
+    status, body = asyncio.run(send(args.url, event, args.secret))
+    print(status, body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+
+import yaml
+
+from plex_roster import PlexRoster
+
+
+def load_server_configs(path, default):
+    """Server settings from servers.yml, or just `default` (the .env server) without one.
+
+    Entries need a name, the Plex server name. url, token and capacity fall back to the
+    .env values, each server gets its own connection cache file.
+    """
+    if not os.path.exists(path):
+        return [default]
+    with open(path, "r") as file:
+        servers = (yaml.safe_load(file) or {}).get("servers")
+    if not servers:
+        raise ValueError(f"{path} has no servers")
+    configs = []
+    names = set()
+    for server in servers:
+        if not server.get("name"):
+            raise ValueError(f"a server in {path} has no name")
+        if server["name"] in names:
+            raise ValueError(f"server {server['name']} is defined twice")
+        names.add(server["name"])
+        configs.append(
+            {
+                "name": server["name"],
+                "url": server.get("url"),
+                "token": server.get("token") or default["token"],
+                "capacity": int(server.get("capacity") or default["capacity"]),
+                "cache_file": server.get("cache_file")
+                or f".plex_cache.{server['name']}.json",
+            }
+        )
+    return configs
+
+
+class PoolServer:
+    """One Plex server of the pool, with its own gateway, roster, capacity and sections.
+
+    The section lists are filled in place by set_sections, from the connection cache
+    first and then from the server, so other objects can hold references to them.
+    """
+
+    def __init__(self, config, gateway, capacity):
+        self.name = config["name"]
+        self.url = config["url"]
+        self.token = config["token"]
+        self.cache_file = config["cache_file"]
+        self.gateway = gateway
+        self.capacity = capacity
+        self.roster = PlexRoster(gateway)
+        self.sections_standard = []
+        self.sections_all = []
+        self.sections_movies = []
+        self.sections_tv = []
+
+    def set_sections(self, sections):
+        # sections are LibrarySection objects, or {"title", "type", "key"} dicts from the cache.
+        # plexapi accepts section titles when sharing, so cached entries are enough for invites.
+        standard = []
+        all_sections = []
+        movies = []
+        tv = []
+        for section in sections:
+            if isinstance(section, dict):
+                title = section["title"]
+                if "4K" not in title:
+                    standard.append(title)
+                all_sections.append(title)
+                continue
+            if "4K" not in section.title:
+                standard.append(section)
+            all_sections.append(section)
+
+            if section.type == "movie":
+                movies.append(section)
+            elif section.type == "show":
+                tv.append(section)
+        self.sections_standard[:] = standard
+        self.sections_all[:] = all_sections
+        if movies or tv:
+            self.sections_movies[:] = movies
+            self.sections_tv[:] = tv
+
+    @property
+    def sections_loaded(self):
+        # Empty until the connection cache or the server itself has listed them
+        return bool(self.sections_all)
+
+    @property
+    def has_4k(self):
+        return len(self.sections_all) > len(self.sections_standard)
+
+    def sections_for(self, plan):
+        return self.sections_all if plan["4k_enabled"] else self.sections_standard
+
+    async def load(self):
+        status = await self.capacity.status()
+        return (status["used"] + status["reserved"]) / max(status["limit"], 1)
+
+
+class ServerPool:
+    """The Plex servers subscribers are spread over.
+
+    A subscriber's server is stored on their record as "server", records from before
+    the pool have none and belong to the primary (first) server. New subscribers are
+    placed on the least loaded server that has the sections their plan needs.
+    """
+
+    def __init__(self, servers, reservations):
+        self.servers = {server.name: server for server in servers}
+        self.primary = servers[0]
+        self.reservations = reservations
+
+    def __iter__(self):
+        return iter(self.servers.values())
+
+    def __len__(self):
+        return len(self.servers)
+
+    def get(self, name):
+        """The server a record is on, None if it was removed from the pool."""
+        if name is None:
+            return self.primary
+        return self.servers.get(name)
+
+    def record_filter(self, server):
+        """Mongo filter for the subscribers on a server."""
+        if server is self.primary:
+            return {"server": {"$in": [server.name, None]}}
+        return {"server": server.name}
+
+    def serves(self, server, plan):
+        """Whether server can take subscribers on plan.
+
+        4K plans are kept to the servers with 4K sections, when the pool has any. A
+        pool without 4K libraries shares everything it has, as a single server does.
+        """
+        if not plan["4k_enabled"] or server.has_4k:
+            return True
+        return not any(other.has_4k for other in self)
+
+    async def ranked(self, plan):
+        """Servers that can take the plan, least loaded first."""
+        candidates = [server for server in self if self.serves(server, plan)]
+        loads = {server.name: await server.load() for server in candidates}
+        # Stable, so ties go to the server listed first
+        return sorted(candidates, key=lambda server: loads[server.name])
+
+    async def place(self, discord_id, plan):
+        """Reserve a slot for discord_id, returns the server or None if all are full."""
+        reservation = await self.reservations.find_one({"_id": discord_id})
+        if reservation is not None:
+            server = self.servers.get(reservation["server"])
+            if (
+                server is not None
+                and self.serves(server, plan)
+                and await server.capacity.reserve(discord_id)
+            ):
+                return server  # renewed
+            await self.release(discord_id)
+        for server in await self.ranked(plan):
+            if await server.capacity.reserve(discord_id):
+                return server
+        return None
+
+    async def is_full(self, discord_id, plan):
+        if await self.reservations.find_one({"_id": discord_id}):
+            return False  # they already hold a slot
+        for server in await self.ranked(plan):
+            if not await server.capacity.is_full():
+                return False
+        return True
+
+    async def release(self, discord_id):
+        """Give back discord_id's reserved slot, on whichever server holds it."""
+        reservation = await self.reservations.find_one({"_id": discord_id})
+        if reservation is None:
+            return
+        server = self.servers.get(reservation["server"])
+        if server is not None:
+            await server.capacity.release(discord_id)
+        else:
+            await self.reservations.delete_one({"_id": discord_id})
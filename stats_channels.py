@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import discord
+
+# Discord only allows two name changes per channel every ten minutes
+RENAME_LIMIT = 2
+RENAME_WINDOW = 600
+
+
+class StatsChannels:
+    """Keeps one locked voice channel per stat and renames it only when its value changes.
+
+    Channel IDs are persisted in the settings collection so the same channels are reused
+    across restarts. Renames that would hit Discord's rate limit are held back and coalesced,
+    so only the latest value is sent once a rename slot frees up.
+    """
+
+    def __init__(self, settings, suffixes):
+        self.settings = settings
+        # stat key -> name suffix, e.g. {"movies": "Movies"}
+        self.suffixes = suffixes
+        self.channels = {}
+        self._pending = {}
+        self._renames = {}
+        self._task = None
+
+    async def ensure(self, category):
+        """Find or create the channels in category, returns the number of API calls made."""
+        calls = 0
+        if len(self.channels) == len(self.suffixes) and all(
+            category.guild.get_channel(c.id) for c in self.channels.values()
+        ):
+            return calls
+        self.channels = {}
+        record = await self.settings.find_one({"_id": "stats_channels"}) or {}
+        saved = record.get("channels", {})
+        for key, suffix in self.suffixes.items():
+            channel = self.channels.get(key)
+            if channel is None and key in saved:
+                channel = category.guild.get_channel(saved[key])
+            if channel is None:
+                # Adopt a channel left over from before IDs were persisted
+                channel = next(
+                    (
+                        c
+                        for c in category.voice_channels
+                        if c.name.endswith(f" {suffix}") or c.name == suffix
+                    ),
+                    None,
+                )
+            if channel is None:
+                channel = await category.create_voice_channel(
+                    name=suffix,
+                    overwrites={
+                        category.guild.default_role: discord.PermissionOverwrite(
+                            connect=False
+                        )
+                    },
+                )
+                calls += 1
+            self.channels[key] = channel
+        ids = {key: channel.id for key, channel in self.channels.items()}
+        if ids != saved:
+            await self.settings.update_one(
+                {"_id": "stats_channels"}, {"$set": {"channels": ids}}, upsert=True
+            )
+        return calls
+
+    def update(self, key, value):
+        """Queue a new value for a stat, returns True if it differs from the channel name."""
+        name = f"{value} {self.suffixes[key]}"
+        if self._channel(key).name == name:
+            self._pending.pop(key, None)
+            return False
+        self._pending[key] = name
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+        return True
+
+    def _channel(self, key):
+        # Prefer the guild cache, it is kept up to date by gateway events
+        channel = self.channels[key]
+        return channel.guild.get_channel(channel.id) or channel
+
+    def _next_slot(self, key):
+        now = time.monotonic()
+        recent = [t for t in self._renames.get(key, []) if now - t < RENAME_WINDOW]
+        self._renames[key] = recent
+        if len(recent) < RENAME_LIMIT:
+            return 0
+        return recent[0] + RENAME_WINDOW - now
+
+    async def _flush(self):
+        while self._pending:
+            waits = []
+            for key in list(self._pending):
+                wait = self._next_slot(key)
+                if wait > 0:
+                    waits.append(wait)
+                    continue
+                name = self._pending.pop(key)
+                channel = self._channel(key)
+                if channel.name == name:
+                    continue
+                try:
+                    await channel.edit(name=name)
+                    self._renames[key].append(time.monotonic())
+                except discord.HTTPException as e:
+                    print(f"Failed to rename stats channel {channel.id}: {e}")
+            if self._pending:
+                await asyncio.sleep(min(waits) if waits else 1)
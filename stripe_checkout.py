@@ -0,0 +1,141 @@
+from async_stripe import stripe
+
+from metrics import timed, track
+
+PAGE_SIZE = 100
+
+# Per-plan "checkout" setting in plans.yml
+INVOICE = "invoice"
+CHECKOUT_SESSION = "checkout_session"
+CHECKOUT_MODES = (INVOICE, CHECKOUT_SESSION)
+
+
+@timed("stripe")
+async def create_customer(email, discord_id):
+    customer = await stripe.Customer.create(
+        email=email, metadata={"discord_id": str(discord_id)}
+    )
+    return customer.id
+
+
+@timed("stripe")
+async def create_invoice(customer_id, price_id):
+    """Hosted invoice for one price, returns (invoice id, payable URL). Three calls."""
+    invoice = await stripe.Invoice.create(
+        customer=customer_id,
+        auto_advance=True,
+        pending_invoice_items_behavior="exclude",
+    )
+    await stripe.InvoiceItem.create(
+        customer=customer_id, invoice=invoice.id, price=price_id
+    )
+    finalised_invoice = await stripe.Invoice.finalize_invoice(invoice.id)
+    return finalised_invoice.id, finalised_invoice.hosted_invoice_url
+
+
+@timed("stripe")
+async def create_checkout_session(
+    price_id, email, customer_id, discord_id, plan_name, success_url
+):
+    """Checkout Session for one price, returns (session id, payable URL). One call.
+
+    Without a known customer Stripe creates one on payment, it is read back from the
+    completed session.
+    """
+    params = {
+        "mode": "payment",
+        "line_items": [{"price": price_id, "quantity": 1}],
+        "client_reference_id": str(discord_id),
+        "metadata": {"discord_id": str(discord_id), "plan_name": plan_name},
+        "success_url": success_url,
+    }
+    if customer_id:
+        params["customer"] = customer_id
+    else:
+        params["customer_email"] = email
+        params["customer_creation"] = "always"
+    session = await stripe.checkout.Session.create(**params)
+    return session.id, session.url
+
+
+@timed("stripe")
+async def retrieve_payment(payment):
+    """Fetch a payment record's invoice or session, returns (paid, customer id)."""
+    if payment.get("checkout") == CHECKOUT_SESSION:
+        session = await stripe.checkout.Session.retrieve(payment["invoice_id"])
+        return session.payment_status == "paid", session.customer
+    invoice = await stripe.Invoice.retrieve(payment["invoice_id"])
+    return invoice.status == "paid", invoice.customer
+
+
+@timed("stripe")
+async def void_payment(payment):
+    if payment.get("checkout") == CHECKOUT_SESSION:
+        await stripe.checkout.Session.expire(payment["invoice_id"])
+    else:
+        await stripe.Invoice.void_invoice(payment["invoice_id"])
+
+
+def created_at(payment):
+    # Payment records have no timestamp, the ObjectId carries one
+    return payment["_id"].generation_time.replace(tzinfo=None)
+
+
+async def list_all(resource, **params):
+    with track("stripe", "list"):
+        page = await resource.list(limit=PAGE_SIZE, **params)
+    async for obj in page.auto_paging_iter():
+        yield obj
+
+
+async def sweep_payments(pending, stale_before):
+    """Match pending payment records against Stripe with one paged listing per status.
+
+    Open invoices and sessions created before stale_before are voided or expired.
+    Returns (paid, stale): paid is a list of (payment, customer id), stale the payments
+    that can no longer be paid.
+    """
+    waiting = {INVOICE: {}, CHECKOUT_SESSION: {}}
+    for payment in pending:
+        waiting[payment.get("checkout", INVOICE)][payment["invoice_id"]] = payment
+    paid = []
+    stale = []
+    for mode, resource, paid_status in (
+        (INVOICE, stripe.Invoice, "paid"),
+        (CHECKOUT_SESSION, stripe.checkout.Session, "complete"),
+    ):
+        payments = waiting[mode]
+        if not payments:
+            continue
+        # Nothing we wait on is older than the oldest pending record
+        created = {"gte": int(min(map(created_at, payments.values())).timestamp())}
+        alive = set()
+        async for obj in list_all(resource, status=paid_status, created=created):
+            if obj.id not in payments:
+                continue
+            if mode == CHECKOUT_SESSION and obj.payment_status != "paid":
+                alive.add(obj.id)  # delayed payment method still processing
+                continue
+            paid.append((payments.pop(obj.id), obj.customer))
+        async for obj in list_all(resource, status="open", created=created):
+            if obj.id not in payments:
+                continue
+            alive.add(obj.id)
+            if created_at(payments[obj.id]) < stale_before:
+                try:
+                    await void_payment(payments[obj.id])
+                    stale.append(payments[obj.id])
+                except stripe.error.StripeError as e:
+                    print(f"Could not cancel stale payment {obj.id}: {e}")
+        # Neither open nor paid in the listings: voided or expired elsewhere, or it
+        # changed state between the two listings, so confirm these one at a time
+        for payment_id, payment in payments.items():
+            if payment_id in alive:
+                continue
+            with track("stripe", "retrieve"):
+                obj = await resource.retrieve(payment_id)
+            if obj.status == "paid" or obj.get("payment_status") == "paid":
+                paid.append((payment, obj.customer))
+            elif obj.status in ("void", "uncollectible", "expired"):
+                stale.append(payment)
+    return paid, stale
@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+import time
+import zipfile
+
+import aiohttp
+import pymongo
+
+VALID_SUBTITLE_EXTENSIONS = [".srt", ".smi", ".ssa", ".ass", ".vtt"]
+
+# Attachments are held in memory up to this size, then spill to a temp file
+SPOOL_SIZE = 1024 * 1024
+MAX_SUBTITLE_SIZE = 5 * 1024 * 1024
+MAX_ZIP_SIZE = 25 * 1024 * 1024
+# Guards against zip bombs, checked against the sizes in the zip's directory
+MAX_ZIP_FILES = 200
+MAX_UNZIPPED_SIZE = 100 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# S01E02, s1.e2, 1x02
+EPISODE_PATTERN = re.compile(
+    r"(?:s(\d{1,2})[ ._-]*e(\d{1,3})|\b(\d{1,2})x(\d{2,3})\b)", re.IGNORECASE
+)
+
+
+class SubtitleError(Exception):
+    pass
+
+
+def is_subtitle(filename):
+    return os.path.splitext(filename.lower())[1] in VALID_SUBTITLE_EXTENSIONS
+
+
+def episode_number(filename):
+    """(season, episode) from a file name, or None."""
+    match = EPISODE_PATTERN.search(os.path.basename(filename))
+    if match is None:
+        return None
+    season, episode = (int(n) for n in match.groups() if n is not None)
+    return season, episode
+
+
+def subtitle_key(rating_key, digest):
+    # The same file may go on different media, never twice on the same one
+    return f"{rating_key}:{digest}"
+
+
+class RateLimit:
+    """Allows each user `limit` submissions in any `per` seconds."""
+
+    def __init__(self, limit, per=3600):
+        self.limit = limit
+        self.per = per
+        self._times = collections.defaultdict(collections.deque)
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        times = self._times[user_id]
+        while times and times[0] <= now - self.per:
+            times.popleft()
+        if len(times) >= self.limit:
+            return False
+        times.append(now)
+        return True
+
+    def retry_in(self, user_id):
+        times = self._times[user_id]
+        return int(times[0] + self.per - time.monotonic()) + 1 if times else 0
+
+
+class Upload:
+    def __init__(self, media, filename, data, digest):
+        self.media = media
+        self.filename = filename
+        self.data = data  # spooled temp file, closed (and deleted) once uploaded
+        self.digest = digest
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class SubtitlePipeline:
+    """Streams subtitle attachments to Plex through a bounded queue of upload workers.
+
+    Attachments are downloaded into spooled temp files and hashed on the way, so
+    nothing is kept on disk after the upload. A record keyed by media and hash is
+    claimed before uploading, identical files for the same media are skipped. A zip
+    uploaded against a show or season has each subtitle matched to its episode by the
+    SxxEyy in the file name.
+    """
+
+    def __init__(
+        self, collection, gateway, workers=2, queue_size=50, rate_limit=10, per=3600
+    ):
+        self.collection = collection
+        self.gateway = gateway
+        self.workers = workers
+        self.rate_limit = RateLimit(rate_limit, per)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._session = None
+        self._tasks = []
+
+    async def start(self):
+        self._session = aiohttp.ClientSession()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    async def submit(self, user_id, media, attachment):
+        """Upload a subtitle or a zip of them to a plexapi item, returns a message for the user."""
+        if not self.rate_limit.allow(user_id):
+            return f"You are uploading too quickly, try again in {self.rate_limit.retry_in(user_id)} seconds."
+        filename = os.path.basename(attachment.filename)
+        bulk = filename.lower().endswith(".zip")
+        if not bulk and not is_subtitle(filename):
+            raise SubtitleError(
+                f"The file must be a zip or one of the following types: {', '.join(VALID_SUBTITLE_EXTENSIONS)}."
+            )
+        data, digest = await self._download(
+            attachment, MAX_ZIP_SIZE if bulk else MAX_SUBTITLE_SIZE
+        )
+        if bulk:
+            return await self._submit_zip(user_id, media, data)
+        uploads = [Upload(media, filename, data, digest)]
+        results = await self._upload_all(user_id, uploads)
+        return results[0]
+
+    async def _download(self, attachment, max_size):
+        if attachment.size > max_size:
+            raise SubtitleError(
+                f"{attachment.filename} is larger than {max_size // (1024 * 1024)} MB."
+            )
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        digest = hashlib.sha256()
+        try:
+            async with self._session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    digest.update(chunk)
+                    data.write(chunk)
+                    if data.tell() > max_size:
+                        raise SubtitleError(f"{attachment.filename} is too large.")
+        except BaseException:
+            data.close()
+            raise
+        data.seek(0)
+        return data, digest.hexdigest()
+
+    async def _submit_zip(self, user_id, media, data):
+        try:
+            episodes = await self._episodes(media)
+            files = await asyncio.to_thread(_extract_subtitles, data)
+        finally:
+            data.close()
+        uploads = []
+        unmatched = []
+        for filename, member, digest in files:
+            number = episode_number(filename)
+            episode = episodes.get(number) if number else None
+            if episode is None:
+                member.close()
+                unmatched.append(filename)
+                continue
+            uploads.append(Upload(episode, filename, member, digest))
+        if not uploads:
+            return (
+                "No subtitles in the zip matched an episode, name them like S01E02.srt."
+            )
+        results = await self._upload_all(user_id, uploads)
+        message = "\n".join(results)
+        if unmatched:
+            message += f"\nNo matching episode for: {', '.join(unmatched)}"
+        return message
+
+    async def _episodes(self, media):
+        if media.type == "episode":
+            raise SubtitleError(
+                "A zip has to be uploaded to a show or season, not an episode."
+            )
+        if media.type not in ("show", "season"):
+            raise SubtitleError("A zip can only be uploaded to a show or season.")
+        episodes = await self.gateway.episodes(media)
+        return {(episode.seasonNumber, episode.index): episode for episode in episodes}
+
+    async def _upload_all(self, user_id, uploads):
+        """Queue the uploads and wait for them, returns one result line per upload."""
+        results = {}
+        queued = []
+        for upload in uploads:
+            if not await self._claim(user_id, upload):
+                upload.data.close()
+                results[upload] = f"{upload.filename}: already uploaded, skipped."
+            else:
+                queued.append(upload)
+        if self._queue.maxsize - self._queue.qsize() < len(queued):
+            await asyncio.gather(*(self._release(upload) for upload in queued))
+            for upload in queued:
+                upload.data.close()
+            raise SubtitleError("Too many subtitle uploads queued, try again shortly.")
+        for upload in queued:
+            self._queue.put_nowait(upload)
+        for upload in queued:
+            results[upload] = await upload.done
+        return [results[upload] for upload in uploads]
+
+    async def _claim(self, user_id, upload):
+        try:
+            await self.collection.insert_one(
+                {
+                    "_id": subtitle_key(upload.media.ratingKey, upload.digest),
+                    "rating_key": upload.media.ratingKey,
+                    "filename": upload.filename,
+                    "discord_id": user_id,
+                    "uploaded_at": datetime.datetime.utcnow(),
+                }
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    async def _release(self, upload):
+        await self.collection.delete_one(
+            {"_id": subtitle_key(upload.media.ratingKey, upload.digest)}
+        )
+
+    async def _worker(self):
+        while True:
+            upload = await self._queue.get()
+            try:
+                await self.gateway.upload_subtitles(
+                    upload.media, upload.filename, upload.data
+                )
+                result = f"{upload.filename}: uploaded."
+            except Exception as e:
+                result = f"{upload.filename}: upload failed. Error: {e}"
+                try:
+                    # Let the same file be tried again
+                    await self._release(upload)
+                except pymongo.errors.PyMongoError as e:
+                    print(f"Could not release subtitle {upload.filename}: {e}")
+            finally:
+                upload.data.close()
+                self._queue.task_done()
+            if not upload.done.done():
+                upload.done.set_result(result)
+
+
+def _extract_subtitles(data):
+    """Subtitle files in a zip as (filename, spooled file, sha256), run off the loop."""
+    try:
+        archive = zipfile.ZipFile(data)
+    except zipfile.BadZipFile:
+        raise SubtitleError("That is not a valid zip file.")
+    with archive:
+        members = [
+            info
+            for info in archive.infolist()
+            if not info.is_dir()
+            and is_subtitle(info.filename)
+            and not info.filename.startswith("__MACOSX/")
+        ]
+        if len(members) > MAX_ZIP_FILES:
+            raise SubtitleError(f"The zip has more than {MAX_ZIP_FILES} subtitles.")
+        if sum(info.file_size for info in members) > MAX_UNZIPPED_SIZE:
+            raise SubtitleError("The zip is too large once extracted.")
+        # Reads stop at file_size, so checking it is enough
+        too_large = [
+            info.filename for info in members if info.file_size > MAX_SUBTITLE_SIZE
+        ]
+        if too_large:
+            raise SubtitleError(f"Too large: {', '.join(too_large)}")
+        files = []
+        member = None
+        try:
+            for info in members:
+                member = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+                digest = hashlib.sha256()
+                with archive.open(info) as source:
+                    while chunk := source.read(CHUNK_SIZE):
+                        digest.update(chunk)
+                        member.write(chunk)
+                member.seek(0)
+                files.append(
+                    (os.path.basename(info.filename), member, digest.hexdigest())
+                )
+                member = None
+        except BaseException:
+            if member is not None:
+                member.close()
+            for _, extracted, _ in files:
+                extracted.close()
+            raise
+        return files
@@ -0,0 +1,44 @@
+import stripe
+from aiohttp import web
+
+
+def stripe_webhook_handler(secret, handlers):
+    """Build an aiohttp handler that verifies Stripe signatures and dispatches events.
+
+    handlers maps an event type (e.g. "invoice.paid") to a coroutine function taking the event.
+    """
+
+    async def handle(request):
+        payload = await request.text()
+        signature = request.headers.get("Stripe-Signature", "")
+        try:
+            event = stripe.Webhook.construct_event(payload, signature, secret)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            print(f"Rejected Stripe webhook: {e}")
+            return web.Response(status=400, text="invalid signature")
+
+        handler = handlers.get(event["type"])
+        if handler is None:
+            return web.Response(text="ignored")
+        try:
+            await handler(event)
+        except Exception as e:
+            # A non-2xx response makes Stripe retry the event later
+            print(f"Error handling Stripe event {event['id']}: {e}")
+            return web.Response(status=500, text="error")
+        return web.Response(text="ok")
+
+    return handle
+
+
+async def start_web_server(routes, host, port):
+    """Serve routes, a list of (method, path, handler), alongside the bot on the current loop."""
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"Web server listening on {host}:{port}")
+    return runner